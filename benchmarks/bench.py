@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# Benchmarks of igstools pipeline stages on synthetic menus, see
+# igstools/synthetic.py. Every stage also checks its output against a
+# reference: the known pixels of generated pictures, straightforward
+# reimplementations of the decoder and color conversion, the same menu
+# read from M2TS and from menu file, and igstopng outputs with different
+# options. Exits with status 1 if any of them doesn't match.
+#
+# Usage: python3 benchmarks/bench.py [--preset small|medium|large]
+
+import argparse
+import array
+import hashlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from igstools import IGSMenu, synthetic, export  # noqa
+from igstools.export import (  # noqa
+    picture_data_to_rgb, _build_rgb_palette, YCBCR_COEFF,
+)
+from igstools.parser import (  # noqa
+    decode_rle, decode_rle_data, igs_parsing_segments,
+)
+from igstools.ts_reader import igs_demuxer_iter  # noqa
+
+MNU_NAME = "bench.mnu"
+M2TS_NAME = "bench.m2ts"
+
+PRESETS = {
+    "small": {
+        "menu": {
+            "pages": 2, "bogs": 3, "buttons": 2, "frames": 2,
+            "picture_width": 100, "picture_height": 60,
+        },
+        "filler": 2000,
+    },
+    "medium": {
+        "menu": {
+            "pages": 2, "bogs": 4, "buttons": 4, "frames": 5,
+            "picture_width": 300, "picture_height": 150,
+        },
+        "filler": 20000,
+    },
+    "large": {
+        "menu": {
+            "pages": 1, "bogs": 2, "buttons": 2, "frames": 10,
+            "picture_width": 800, "picture_height": 400,
+        },
+        "filler": 200000,
+    },
+}
+
+
+def reference_decode_rle(data, width, height):
+    # Decodes one code at a time
+    ret = bytearray()
+    position = 0
+    while position < len(data):
+        color = data[position]
+        position += 1
+        run = 1
+        if color == 0:
+            flags = data[position]
+            position += 1
+            run = flags & 0x3f
+            if flags & 0x40:
+                run = (run << 8) | data[position]
+                position += 1
+
+            if flags & 0x80:
+                color = data[position]
+                position += 1
+
+        if run == 0:
+            assert len(ret) % width == 0
+            continue
+
+        ret += bytes((color,)) * run
+
+    assert len(ret) == width * height
+    return bytes(ret)
+
+
+def reference_picture_to_rgb(pic, palette, matrix, tv_range):
+    rgb_palette = _build_rgb_palette(palette, YCBCR_COEFF[matrix], tv_range)
+    ret = array.array("H")
+    for index in pic.picture_data:
+        ret.extend(rgb_palette[index * 4:index * 4 + 4])
+
+    return ret
+
+
+def _best_time(func, repeat):
+    # Returns (best time, result of the last run)
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def _segment_summary(segments):
+    return [(seg["seg_type"], bytes(seg["raw_data"])) for seg in segments]
+
+
+def _run_igstopng(folder, name, *options, menu_cache=False):
+    # Returns {output file: md5} of PNG files. The menu cache is disabled
+    # unless menu_cache is set, so that every run parses its input.
+    if not menu_cache:
+        options += ("--no-menu-cache",)
+
+    for entry in os.listdir(folder):
+        if entry.endswith(".png"):
+            os.remove(os.path.join(folder, entry))
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.join(os.path.dirname(__file__), os.pardir)] +
+        ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []),
+    )
+    subprocess.check_call(
+        [sys.executable, "-m", "igstools", name] + list(options),
+        cwd=folder, env=env,
+    )
+    ret = {}
+    prefix = os.path.splitext(name)[0]
+    for entry in sorted(os.listdir(folder)):
+        if entry.endswith(".png"):
+            with open(os.path.join(folder, entry), "rb") as f:
+                key = entry[len(prefix):]
+                ret[key] = hashlib.md5(f.read()).hexdigest()
+
+    return ret
+
+
+def make_fixtures(folder, preset):
+    # Returns (menu data, M2TS data, {picture_id: pixels}), both files are
+    # also written to folder
+    menu_data, pixels = synthetic.make_menu(**preset["menu"])
+    m2ts_data = synthetic.make_m2ts(
+        [(synthetic.IGS_PID, menu_data)], filler=preset["filler"],
+    )
+    with open(os.path.join(folder, MNU_NAME), "wb") as f:
+        f.write(menu_data)
+
+    with open(os.path.join(folder, M2TS_NAME), "wb") as f:
+        f.write(m2ts_data)
+
+    return menu_data, m2ts_data, pixels
+
+
+def run_benchmarks(folder, menu_data, pixels, repeat, jobs):
+    # Yields (stage, best time, whether output matches)
+    mnu_path = os.path.join(folder, MNU_NAME)
+    m2ts_path = os.path.join(folder, M2TS_NAME)
+    menu = IGSMenu(mnu_path)
+    pictures = list(menu.pictures.values())
+
+    def _decode():
+        return [decode_rle_data(pic.rle_bitmap_data, pic.width, pic.height)
+                for pic in pictures]
+
+    elapsed, decoded = _best_time(_decode, repeat)
+    yield "rle_decode", elapsed, all(
+        data == pixels[pic.id] and
+        data == reference_decode_rle(pic.rle_bitmap_data, pic.width,
+                                     pic.height) and
+        data == decode_rle(io.BytesIO(pic.rle_bitmap_data), pic.width,
+                           pic.height)
+        for pic, data in zip(pictures, decoded)
+    )
+
+    palette = menu.palettes[0]
+    matrix = "709"
+    rgb_palette = _build_rgb_palette(palette, YCBCR_COEFF[matrix], True)
+
+    def _to_rgb():
+        ret = []
+        for pic in pictures:
+            buffer = array.array("H", bytes(pic.width * pic.height * 8))
+            picture_data_to_rgb(pic, rgb_palette, buffer)
+            ret.append(buffer)
+
+        return ret
+
+    elapsed, rendered = _best_time(_to_rgb, repeat)
+    yield "picture_to_rgb", elapsed, all(
+        buffer == reference_picture_to_rgb(pic, palette, matrix, True)
+        for pic, buffer in zip(pictures, rendered)
+    )
+
+    if export.numpy is not None:
+        # Also run the fallback without NumPy
+        numpy_module, export.numpy = export.numpy, None
+        try:
+            elapsed, rendered_stdlib = _best_time(_to_rgb, repeat)
+        finally:
+            export.numpy = numpy_module
+
+        yield "picture_to_rgb_stdlib", elapsed, rendered_stdlib == rendered
+
+    def _demux():
+        with open(m2ts_path, "rb") as f:
+            return b"".join(igs_demuxer_iter(f))
+
+    elapsed, demuxed = _best_time(_demux, repeat)
+    yield "ts_demux", elapsed, (
+        _segment_summary(igs_parsing_segments(io.BytesIO(demuxed))) ==
+        _segment_summary(igs_parsing_segments(io.BytesIO(menu_data)))
+    )
+
+    def _parse():
+        segments = list(igs_parsing_segments(io.BytesIO(menu_data)))
+        for seg in segments:
+            # Pages are parsed lazily
+            list(seg.get("pages", ()))
+
+        return segments
+
+    elapsed, _ = _best_time(_parse, repeat)
+    yield "parse", elapsed, True
+
+    def _load(path):
+        menu = IGSMenu(path)
+        menu.decode_pictures()
+        return {pic.id: pic.picture_data
+                for pic in menu.pictures.values()}
+
+    for name, path in (("load_mnu", mnu_path), ("load_m2ts", m2ts_path)):
+        elapsed, loaded = _best_time(lambda: _load(path), repeat)
+        yield name, elapsed, loaded == pixels
+
+    outputs = {}
+    for name, options in (
+        ("igstopng_mnu", (MNU_NAME,)),
+        ("igstopng_m2ts", (M2TS_NAME,)),
+        ("igstopng_jobs", (M2TS_NAME, "--jobs", str(jobs))),
+    ):
+        elapsed, outputs[name] = _best_time(
+            lambda: _run_igstopng(folder, *options), repeat,
+        )
+        yield name, elapsed, (
+            bool(outputs[name]) and
+            outputs[name] == outputs["igstopng_mnu"]
+        )
+
+    # Parsing is skipped once the menu cache has been written, which is
+    # done by a first run outside of timing
+    _run_igstopng(folder, M2TS_NAME, menu_cache=True)
+    elapsed, cached = _best_time(
+        lambda: _run_igstopng(folder, M2TS_NAME, menu_cache=True), repeat,
+    )
+    yield "igstopng_m2ts_cached", elapsed, (
+        cached == outputs["igstopng_mnu"]
+    )
+
+    # Indexed output has different bytes, but the same files
+    elapsed, indexed = _best_time(
+        lambda: _run_igstopng(folder, MNU_NAME, "--format", "indexed"),
+        repeat,
+    )
+    yield "igstopng_indexed", elapsed, (
+        sorted(indexed) == sorted(outputs["igstopng_mnu"])
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of igstools on synthetic menus",
+    )
+    parser.add_argument(
+        "--preset", choices=sorted(PRESETS), default="small",
+        help="size of generated menu and M2TS file. Default is small.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, metavar="N",
+        help="run every stage N times and report the best. Default is 3.",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=2, metavar="N",
+        help="number of processes for the igstopng --jobs run.",
+    )
+    args = parser.parse_args()
+
+    all_matched = True
+    with tempfile.TemporaryDirectory() as folder:
+        menu_data, m2ts_data, pixels = make_fixtures(
+            folder, PRESETS[args.preset],
+        )
+        print("Menu: {} bytes, {} pictures; M2TS: {} bytes".format(
+            len(menu_data), len(pixels), len(m2ts_data),
+        ))
+        print("{:<24}{:>12}  {}".format("stage", "best (s)", "output"))
+        for stage, elapsed, matched in run_benchmarks(
+            folder, menu_data, pixels, args.repeat, args.jobs,
+        ):
+            all_matched = all_matched and matched
+            print("{:<24}{:>12.4f}  {}".format(
+                stage, elapsed, "ok" if matched else "MISMATCH",
+            ))
+
+    if not all_matched:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
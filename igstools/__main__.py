@@ -1,17 +1,24 @@
 import argparse
+import json
 import os
 import sys
 import traceback
 from contextlib import contextmanager
 import functools
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 from . import IGSMenu
-from .export import menu_to_png, YCBCR_COEFF
+from .export import menu_to_png, YCBCR_COEFF, PNG_FORMATS
 from .exportjson import menu_to_json
+from .ts_reader import probe_igs_pids
+from .picture_cache import PictureCache
+from .menu_cache import source_key, MENU_CACHE_SUFFIX
 from . import debugging
+from . import stats
 
 ENTRYPOINT = "igstopng"
+STDIN_PREFIX = "stdin"
 
 
 @contextmanager
@@ -29,12 +36,204 @@ def _error_msg(msg, verbose, debug):
         sys.exit(1)
 
 
+def _seconds_to_pts(value):
+    return round(float(value) * 90000)
+
+
+def _open_picture_cache(args):
+    if not args.cache_dir:
+        return None
+
+    return PictureCache(
+        args.cache_dir,
+        max_size=args.cache_size * 1024 * 1024,
+        store_rgba=args.cache_rgba,
+    )
+
+
+def _read_menus(name, args, options):
+    source = sys.stdin.buffer if name == "-" else name
+    if not args.all_epochs:
+        if name == "-":
+            return [IGSMenu.from_stream(source, **options)]
+
+        return [IGSMenu(source, **options)]
+
+    return IGSMenu.load_all(source, **options)
+
+
+def _read_cached_menus(name, args, options):
+    # Menus are saved to a cache file next to the source file, and loaded
+    # from there as long as the source file and options don't change
+    cache_path = name + MENU_CACHE_SUFFIX
+    key = source_key(
+        name, all_epochs=args.all_epochs, start=args.start, end=args.end,
+    )
+    menus = IGSMenu.load_cache_all(
+        cache_path, key,
+        decode_workers=options["decode_workers"],
+        picture_cache=options["picture_cache"],
+    )
+    if menus is not None:
+        return menus
+
+    menus = _read_menus(name, args, options)
+    try:
+        IGSMenu.save_cache_all(menus, cache_path, key)
+    except OSError:
+        logging.getLogger("main").info(
+            "Unable to save menu cache to %s", cache_path, exc_info=True,
+        )
+
+    return menus
+
+
+def _load_menus(name, args, workers=None):
+    # Returns list of (suffix of output files, menu)
+    workers = args.jobs if workers is None else workers
+    options = {
+        "scan_workers": workers,
+        "decode_workers": workers,
+        "picture_cache": _open_picture_cache(args),
+        "start": args.start,
+        "end": args.end,
+    }
+    if name != "-":
+        options["use_index"] = args.index
+
+    if name == "-" or args.no_menu_cache:
+        menus = _read_menus(name, args, options)
+    else:
+        menus = _read_cached_menus(name, args, options)
+
+    if not args.all_epochs or len(menus) == 1:
+        return [("", menus[0])]
+
+    return [
+        ("_epoch{0.epoch}".format(menu) if menu.pid is None else
+         "_pid{0.pid}_epoch{0.epoch}".format(menu), menu)
+        for menu in menus
+    ]
+
+
+def _export_menus(menus, name, args):
+    prefix, _ = os.path.splitext(name if name != "-" else STDIN_PREFIX)
+    for suffix, menu in menus:
+        menu_prefix = prefix + suffix
+        if args.json:
+            menu_to_json(
+                menu, menu_prefix + ".json",
+                matrix=args.matrix,
+                tv_range=args.tv_range,
+                fmt=args.format,
+            )
+        else:
+            menu_to_png(
+                menu, menu_prefix + "_{0.id}_{state1}_{state2}.png",
+                matrix=args.matrix,
+                tv_range=args.tv_range,
+                fmt=args.format,
+            )
+
+
+def _find_bdmv_streams(bdmv, verbose=False):
+    # Returns (M2TS files with IGS streams, error messages of files that
+    # can't be probed)
+    stream_dir = os.path.join(bdmv, "STREAM")
+    if not os.path.isdir(stream_dir):
+        raise ValueError("{} is not a BDMV folder".format(bdmv))
+
+    ret = []
+    errors = []
+    for name in sorted(os.listdir(stream_dir)):
+        path = os.path.join(stream_dir, name)
+        if not name.lower().endswith(".m2ts") or not os.path.isfile(path):
+            continue
+
+        try:
+            with open(path, "rb") as f:
+                if probe_igs_pids(f):
+                    ret.append(path)
+        except (OSError, ValueError, EOFError):
+            msg = "Failed to probe {}".format(path)
+            if verbose:
+                msg += "\n" + traceback.format_exc()
+
+            errors.append(msg)
+
+    return ret, errors
+
+
+def _print_stats(name, data, fmt):
+    if fmt == "json":
+        print(json.dumps({"file": name, **data}))
+        return
+
+    print("Stats for {}:".format(name))
+    print(stats.format_report(data))
+
+
+def _export_file(name, args):
+    # Runs in worker processes of _export_files, returns error message
+    # instead of raising, and stats of the file if --stats is given
+    if args.stats:
+        stats.enable()
+
+    stage = "Failed to parse"
+    try:
+        menus = _load_menus(name, args, workers=1)
+        stage = "Unable to generate image for"
+        _export_menus(menus, name, args)
+    except Exception:
+        msg = "{} {}".format(stage, name)
+        if args.verbose:
+            msg += "\n" + traceback.format_exc()
+
+        return msg, None
+    finally:
+        collected = stats.disable()
+
+    return None, collected and collected.to_dict()
+
+
+def _export_files(files, args, probe_errors=()):
+    # Exports each file in a separate process, returns whether all of them
+    # succeeded. Files that failed to be probed are counted as failures.
+    print("Found {} M2TS files with IGS streams".format(len(files)))
+    failures = []
+    for error in probe_errors:
+        print("Error:", error, file=sys.stderr)
+        failures.append(error)
+
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        futures = [executor.submit(_export_file, name, args)
+                   for name in files]
+        for name, future in zip(files, futures):
+            error, stats_data = future.result()
+            if error:
+                print("Error:", error, file=sys.stderr)
+                failures.append(name)
+            else:
+                print("Exported {}".format(name))
+                if stats_data:
+                    _print_stats(name, stats_data, args.stats_format)
+
+    print("{} succeeded, {} failed".format(
+        len(files) + len(probe_errors) - len(failures), len(failures),
+    ))
+    return not failures
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog=ENTRYPOINT,
         description="Export bluray IGS menu to PNG images or JSON data",
     )
-    parser.add_argument("files", metavar="file", nargs="+")
+    parser.add_argument(
+        "files", metavar="file", nargs="*",
+        help="menu or M2TS file, - to read from stdin. Output files of " +
+             "stdin are prefixed with \"{}\".".format(STDIN_PREFIX),
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true",
         help="show detailed information on error",
@@ -52,10 +251,76 @@ def main():
         "--full-range", dest="tv_range", action="store_false",
         help="specify that menu file is in full range. Default is TV range.",
     )
+    parser.add_argument(
+        "--format", choices=PNG_FORMATS, default="rgba16",
+        help="format of exported PNG images: 16-bit RGBA (default), " +
+             "8-bit RGBA, or indexed colors with transparency, which is " +
+             "the native format of menu pictures.",
+    )
     parser.add_argument(
         "-j", "--json", action="store_true",
         help="output JSON data instead of PNG images.",
     )
+    parser.add_argument(
+        "--all-epochs", action="store_true",
+        help="export menus of all epochs in all IGS streams, instead of " +
+             "stopping after the first complete menu.",
+    )
+    parser.add_argument(
+        "--index", action="store_true",
+        help="save positions of IGS packets alongside M2TS files, so that " +
+             "later runs don't need to scan the whole file again.",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1, metavar="N",
+        help="use N processes to scan M2TS files and decode pictures, or " +
+             "to export files in parallel with --bdmv.",
+    )
+    parser.add_argument(
+        "--bdmv", metavar="DIR",
+        help="export menus of all M2TS files with IGS streams in the " +
+             "STREAM folder of DIR.",
+    )
+    parser.add_argument(
+        "--start", type=_seconds_to_pts, metavar="SECONDS",
+        help="only read IGS segments with PTS not earlier than this from " +
+             "M2TS files.",
+    )
+    parser.add_argument(
+        "--end", type=_seconds_to_pts, metavar="SECONDS",
+        help="only read IGS segments with PTS not later than this from " +
+             "M2TS files.",
+    )
+    parser.add_argument(
+        "--cache-dir", metavar="DIR",
+        help="cache decoded pictures in DIR, so that identical pictures " +
+             "in other files or later runs are not decoded again.",
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=1024, metavar="MB",
+        help="maximum size of the picture cache, least recently used " +
+             "pictures are removed when it is exceeded. Default is 1024.",
+    )
+    parser.add_argument(
+        "--cache-rgba", action="store_true",
+        help="also cache rendered RGBA pictures, for each palette and " +
+             "color matrix they are exported with.",
+    )
+    parser.add_argument(
+        "--no-menu-cache", action="store_true",
+        help="don't save parsed menus to FILE" + MENU_CACHE_SUFFIX +
+             ", or load them from there.",
+    )
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="print time, items and bytes of each processing stage for " +
+             "every file.",
+    )
+    parser.add_argument(
+        "--stats-format", choices=("text", "json"), default="text",
+        help="print stats as a table (default) or as one JSON object per " +
+             "line.",
+    )
     args = parser.parse_args()
     if args.debug:
         debugging.setup()
@@ -63,28 +328,34 @@ def main():
 
     m = functools.partial(_error_msg, verbose=args.verbose, debug=args.debug)
 
+    if not args.files and not args.bdmv:
+        parser.error("no input file is given")
+
+    if args.bdmv:
+        with m("Failed to probe {}".format(args.bdmv)):
+            files, probe_errors = _find_bdmv_streams(
+                args.bdmv, args.verbose,
+            )
+
+        if not _export_files(files, args, probe_errors):
+            sys.exit(1)
+
     for name in args.files:
-        if not os.path.isfile(name):
+        if name != "-" and not os.path.isfile(name):
             print("Error: {} is not found".format(name), file=sys.stderr)
             continue
 
+        if args.stats:
+            stats.enable()
+
         with m("Failed to parse {}".format(name)):
-            menu = IGSMenu(name)
+            menus = _load_menus(name, args)
 
-        prefix, _ = os.path.splitext(name)
         with m("Unable to generate image for {}".format(name)):
-            if args.json:
-                menu_to_json(
-                    menu, prefix + ".json",
-                    matrix=args.matrix,
-                    tv_range=args.tv_range,
-                )
-            else:
-                menu_to_png(
-                    menu, prefix + "_{0.id}_{state1}_{state2}.png",
-                    matrix=args.matrix,
-                    tv_range=args.tv_range,
-                )
+            _export_menus(menus, name, args)
+
+        if args.stats:
+            _print_stats(name, stats.disable().to_dict(), args.stats_format)
 
 
 if __name__ == "__main__":
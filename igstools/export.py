@@ -1,14 +1,29 @@
 import array
+import logging
+from concurrent.futures import ProcessPoolExecutor
 
 import png
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import stats
+from .picture_cache import rendered_key
+
 YCBCR_COEFF = {
     "601": (0.299,  0.587,  0.114 ),
     "709": (0.2126, 0.7152, 0.0722),
 }
+# 16-bit RGBA, 8-bit RGBA and 8-bit palette with alpha (PLTE + tRNS)
+PNG_FORMATS = ("rgba16", "rgba8", "indexed")
 
+log = logging.getLogger("export")
 
-def _ycbcr_to_rgb48(y, cb, cr, coeff, tv_range):
+
+def _ycbcr_to_rgb(y, cb, cr, coeff, tv_range):
+    # Returns R, G and B in [0.0, 255.0]
     assert y >= 0 and y <= 255
     assert cb >= 0 and cb <= 255
     assert cr >= 0 and cr <= 255
@@ -26,7 +41,11 @@ def _ycbcr_to_rgb48(y, cb, cr, coeff, tv_range):
     g = sy - scb * (1 - kb) * kb / kg - scr * (1 - kr) * kr / kg
     b = sy + scb * (1 - kb)
 
-    r, g, b = [max(min(x, 255.0), 0.0) for x in (r, g, b)]
+    return [max(min(x, 255.0), 0.0) for x in (r, g, b)]
+
+
+def _ycbcr_to_rgb48(y, cb, cr, coeff, tv_range):
+    r, g, b = _ycbcr_to_rgb(y, cb, cr, coeff, tv_range)
 
     r = round(r * 256 + r)
     g = round(g * 256 + g)
@@ -35,93 +54,260 @@ def _ycbcr_to_rgb48(y, cb, cr, coeff, tv_range):
     return (r, g, b)
 
 
-def _build_rgb_palette(ycbcr_palette, coeff, tv_range):
-    return {
-        k: array.array("H",
-            _ycbcr_to_rgb48(v["y"], v["cb"], v["cr"], coeff, tv_range) +
-            (v["alpha"] * 256 + v["alpha"],)
-        )
-        for k, v in ycbcr_palette.items()
-    }
+@stats.timed("color_convert")
+def _build_rgb_palette(ycbcr_palette, coeff, tv_range, bitdepth=16):
+    # Returns RGBA of all 256 colors in one contiguous array, channels are
+    # 16-bit or 8-bit depending on bitdepth
+    ret = array.array("H" if bitdepth == 16 else "B")
+    table = ycbcr_palette.table
+    for i in range(0, len(table), 5):
+        _, y, cr, cb, alpha = table[i:i + 5]
+        if bitdepth == 16:
+            ret.extend(_ycbcr_to_rgb48(y, cb, cr, coeff, tv_range))
+            ret.append(alpha * 256 + alpha)
+        else:
+            ret.extend(round(x) for x in _ycbcr_to_rgb(
+                y, cb, cr, coeff, tv_range,
+            ))
+            ret.append(alpha)
+
+    return ret
+
+
+def _png_palette(rgba_palette):
+    # PLTE and tRNS entries of an 8-bit palette
+    return [tuple(rgba_palette[i:i + 4])
+            for i in range(0, len(rgba_palette), 4)]
+
+
+def _transparent_index(rgba_palette):
+    # Returns color index to fill the background of indexed pages with, so
+    # that it looks the same as the zero-filled background of RGBA pages
+    ret = None
+    for i in range(0, len(rgba_palette), 4):
+        entry = tuple(rgba_palette[i:i + 4])
+        if entry == (0, 0, 0, 0):
+            return i // 4
+
+        if entry[3] == 0 and ret is None:
+            ret = i // 4
+
+    return ret
 
 
 def matrix_from_menu_height(height):
     return "709" if height >= 600 else "601"
 
 
+def _expand_picture(pic, rgb_palette):
+    # Looks up all pixels of pic in rgb_palette, returns the channels of all
+    # lines in one block
+    if numpy is not None:
+        dtype = numpy.uint16 if rgb_palette.itemsize == 2 else numpy.uint8
+        palette = numpy.frombuffer(rgb_palette, dtype=dtype).reshape(256, 4)
+        pixels = numpy.frombuffer(pic.picture_data, dtype=numpy.uint8)
+        return palette.take(pixels, axis=0).tobytes()
+
+    data = pic.picture_data
+    if not isinstance(data, bytes):
+        data = bytes(data)
+
+    # Byte N of all pixels is looked up at once with its own translation
+    # table
+    pixel_size = rgb_palette.itemsize * 4
+    palette_bytes = rgb_palette.tobytes()
+    ret = bytearray(len(data) * pixel_size)
+    for i in range(pixel_size):
+        ret[i::pixel_size] = data.translate(palette_bytes[i::pixel_size])
+
+    return ret
+
+
+def _copy_lines(block, buffer, line_size, height, stride, buffer_offset):
+    # Copies height lines of line_size items from block to buffer, lines
+    # are placed stride items apart from buffer_offset
+    with memoryview(buffer) as view, view.cast("B") as target, \
+            memoryview(block) as source:
+        item_size = view.itemsize
+        if stride == line_size:
+            start = buffer_offset * item_size
+            target[start:start + source.nbytes] = source
+            return
+
+        line_bytes = line_size * item_size
+        for y in range(height):
+            start = (buffer_offset + stride * y) * item_size
+            target[start:start + line_bytes] = \
+                source[y * line_bytes:(y + 1) * line_bytes]
+
+
 def picture_data_to_rgb(pic, rgb_palette, buffer, stride=None, buffer_offset=0):
-    stride = stride or pic.width * 4
-    assert stride >= pic.width * 4
+    # stride and buffer_offset are in channels, i.e. items of buffer, which
+    # has the same type as rgb_palette
+    line_size = pic.width * 4
+    stride = stride or line_size
+    assert stride >= line_size
+
+    _copy_lines(
+        _expand_picture(pic, rgb_palette), buffer,
+        line_size, pic.height, stride, buffer_offset,
+    )
+
 
-    for y in range(pic.height):
-        line_start = buffer_offset + stride * y
-        for x in range(pic.width):
-            index = pic.picture_data[y * pic.width + x]
-            color = rgb_palette[index]
-            offset = line_start + x * 4
-            buffer[offset:offset+4] = color
+@stats.timed("color_convert")
+def _render_picture(pic, rgb_palette, buffer, stride=None, buffer_offset=0):
+    # Same as picture_data_to_rgb, but goes through the rendered RGBA cache
+    # of the picture if it has one
+    line_size = pic.width * 4
+    stride = stride or line_size
+    assert stride >= line_size
+
+    block_size = line_size * pic.height * rgb_palette.itemsize
+    stats.add("color_convert", nbytes=block_size)
+    cache = pic.cache
+    if cache is None or not cache.store_rgba:
+        block = _expand_picture(pic, rgb_palette)
+    else:
+        key = rendered_key(pic.cache_key, rgb_palette)
+        block = cache.get(key)
+        if block is None or len(block) != block_size:
+            block = _expand_picture(pic, rgb_palette)
+            cache.put(key, block)
+
+    _copy_lines(block, buffer, line_size, pic.height, stride, buffer_offset)
+
+
+@stats.timed("png_write")
+def _write_png(stream, width, height, pixels, fmt, png_palette=None):
+    # pixels are flat channels of all lines, or color indexes if fmt is
+    # "indexed"
+    if fmt == "indexed":
+        writer = png.Writer(width, height, palette=png_palette, bitdepth=8)
+    else:
+        writer = png.Writer(
+            width, height, alpha=True, greyscale=False,
+            bitdepth=16 if fmt == "rgba16" else 8,
+        )
 
+    writer.write_array(stream, pixels)
+    with memoryview(pixels) as view:
+        stats.add("png_write", nbytes=view.nbytes)
 
-def picture_to_png(pic, palette, stream, matrix, tv_range=True):
+
+def picture_to_png(pic, palette, stream, matrix, tv_range=True,
+                   fmt="rgba16"):
+    # fmt is one of PNG_FORMATS
     if isinstance(stream, str):
         with open(stream, "wb") as f:
-            return picture_to_png(pic, palette, f)
+            return picture_to_png(pic, palette, f, matrix, tv_range, fmt)
 
     width = pic.width
     height = pic.height
 
+    if fmt == "indexed":
+        rgba_palette = _build_rgb_palette(
+            palette, YCBCR_COEFF[matrix], tv_range, bitdepth=8,
+        )
+        _write_png(stream, width, height, pic.picture_data, fmt,
+                   _png_palette(rgba_palette))
+        return
+
     rgb_palette = _build_rgb_palette(
         palette, YCBCR_COEFF[matrix], tv_range,
+        bitdepth=16 if fmt == "rgba16" else 8,
+    )
+    image_buffer = array.array(
+        rgb_palette.typecode, bytes(width * height * 4 * rgb_palette.itemsize),
     )
-    image_buffer = bytearray(width * height * 8)
-    with memoryview(image_buffer) as main_view:
-        with main_view.cast("H") as view:
-            picture_data_to_rgb(pic, rgb_palette, view)
-            writer = png.Writer(width, height, alpha=True, bitdepth=16, greyscale=False)
-            writer.write_array(stream, view)
+    _render_picture(pic, rgb_palette, image_buffer)
+    _write_png(stream, width, height, image_buffer, fmt)
+
+
+def _page_buttons(page, state_selector, width, height):
+    # Yields (button, picture) of buttons that have a picture in the
+    # selected state
+    for bog in page.bogs:
+        for button in bog.buttons.values():
+            state1, state2 = state_selector(button)
+            pic = button.states[state1][state2]
+            if not pic:
+                continue
+
+            assert button.x >= 0 and button.y >= 0
+            assert button.x + pic.width <= width
+            assert button.y + pic.height <= height
+
+            yield button, pic
 
 
 def page_to_png(
     menu, page_index, stream,
     matrix=None, tv_range=True, state_selector=lambda _:("normal", "start"),
+    fmt="rgba16",
 ):
     if isinstance(stream, str):
         with open(stream, "wb") as f:
-            return page_to_png(menu, page_index, f, matrix, tv_range)
+            return page_to_png(menu, page_index, f, matrix, tv_range,
+                               state_selector, fmt)
 
     page = menu.pages[page_index]
     width = menu.width
-    stride = width * 4
     height = menu.height
 
     if not matrix:
         matrix = matrix_from_menu_height(height)
 
+    if fmt == "indexed":
+        rgba_palette = _build_rgb_palette(
+            page.palette, YCBCR_COEFF[matrix], tv_range, bitdepth=8,
+        )
+        background = _transparent_index(rgba_palette)
+        if background is None:
+            log.info("No transparent color in palette of page %d, "
+                     "writing RGBA instead", page.id)
+            fmt = "rgba8"
+
+    if fmt == "indexed":
+        canvas = bytearray((background,)) * (width * height)
+        for button, pic in _page_buttons(page, state_selector, width, height):
+            _copy_lines(
+                pic.picture_data, canvas, pic.width, pic.height,
+                width, width * button.y + button.x,
+            )
+
+        _write_png(stream, width, height, canvas, fmt,
+                   _png_palette(rgba_palette))
+        return
+
+    stride = width * 4
     rgb_palette = _build_rgb_palette(
         page.palette, YCBCR_COEFF[matrix], tv_range,
+        bitdepth=16 if fmt == "rgba16" else 8,
+    )
+    canvas = array.array(
+        rgb_palette.typecode, bytes(width * height * 4 * rgb_palette.itemsize),
     )
-    image_buffer = bytearray(width * height * 8)
-    with memoryview(image_buffer) as main_view:
-        with main_view.cast("H") as view:
-            for bog in page.bogs:
-                for button in bog.buttons.values():
-                    state1, state2 = state_selector(button)
-                    pic = button.states[state1][state2]
-                    if not pic:
-                        continue
-
-                    assert button.x >= 0 and button.y >= 0
-                    assert button.x + pic.width <= width
-                    assert button.y + pic.height <= height
-
-                    picture_data_to_rgb(
-                        pic, rgb_palette, view,
-                        stride=stride,
-                        buffer_offset=stride * button.y + button.x * 4,
-                    )
-
-            writer = png.Writer(width, height, alpha=True, bitdepth=16, greyscale=False)
-            writer.write_array(stream, view)
+    for button, pic in _page_buttons(page, state_selector, width, height):
+        _render_picture(
+            pic, rgb_palette, canvas,
+            stride=stride,
+            buffer_offset=stride * button.y + button.x * 4,
+        )
+
+    _write_png(stream, width, height, canvas, fmt)
+
+
+def _page_pictures(page):
+    # Returns {picture_id: picture} of all states of all buttons
+    ret = {}
+    for bog in page.bogs:
+        for button in bog.buttons.values():
+            for states in button.states.values():
+                for pic in (states["start"], states["stop"]):
+                    if pic:
+                        ret[pic.id] = pic
+
+    return ret
 
 
 def menu_to_png(
@@ -129,8 +315,23 @@ def menu_to_png(
     name_format="page_{0.id}_{state1}_{state2}.png",
     matrix=None,
     tv_range=True,
+    fmt="rgba16",
 ):
+    executor = None
+    if menu.decode_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=menu.decode_workers)
+
+    try:
+        _menu_to_png(menu, name_format, matrix, tv_range, fmt, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _menu_to_png(menu, name_format, matrix, tv_range, fmt, executor):
+    pictures = _page_pictures(menu.pages[0]) if len(menu.pages) else {}
     for i in range(len(menu.pages)):
+        menu.decode_pictures(pictures.values(), executor)
         for state1 in ("normal", "selected", "activated"):
             for state2 in ("start", "stop"):
                 with open(name_format.format(
@@ -153,4 +354,16 @@ def menu_to_png(
                         return "normal", "start"
 
                     page_to_png(menu, i, f, matrix, tv_range,
-                                state_selector=_select_state,)
+                                state_selector=_select_state, fmt=fmt)
+
+        # Keep decoded pictures in memory only if the next page uses them
+        # as well
+        next_pictures = {}
+        if i + 1 < len(menu.pages):
+            next_pictures = _page_pictures(menu.pages[i + 1])
+
+        for picture_id, pic in pictures.items():
+            if picture_id not in next_pictures:
+                pic.unload()
+
+        pictures = next_pictures
@@ -10,10 +10,11 @@ def menu_to_json(
     stream,
     matrix=None,
     tv_range=True,
+    fmt="rgba16",
 ):
     if isinstance(stream, str):
         with open(stream, "w") as f:
-            return menu_to_json(menu, f, matrix, tv_range)
+            return menu_to_json(menu, f, matrix, tv_range, fmt)
 
     if not matrix:
         matrix = matrix_from_menu_height(menu.height)
@@ -46,7 +47,8 @@ def menu_to_json(
                             buffer = BytesIO()
                             picture_to_png(
                                 pic, page.palette, buffer,
-                                matrix=matrix, tv_range=tv_range,)
+                                matrix=matrix, tv_range=tv_range,
+                                fmt=fmt)
                             pictures[palette_id] = base64.b64encode(buffer.getvalue()).decode("utf-8")
 
     json.dump(json_obj, stream, indent=2)
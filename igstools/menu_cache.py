@@ -0,0 +1,199 @@
+import json
+import logging
+import mmap
+import os
+import struct
+
+from .parser import (
+    parse_button_data,
+    BUTTON_SEGMENT, PICTURE_SEGMENT, PALETTE_SEGMENT, PALETTE_ENTRY_SIZE,
+)
+
+# Binary cache of menus, see IGSMenu.save_cache_all. Layout:
+#
+# [4s "IGSC"] [u16 version] [u16 menu_count] [u32 key_len] [u64 blocks_offset]
+# [key_len bytes of key in JSON]
+# For every menu:
+#   [u16 pid] [u16 epoch] [u32 pts] [u32 dts] [u32 button_data_len]
+#   [u8 palette_count] [u16 picture_count]
+#   [button_data_len bytes of button segment data]
+#   [256 * 5 bytes of palette table] for every palette
+#   [u16 id] [u8 ver] [u8 seq_desc] [u16 width] [u16 height] [u32 pts]
+#   [u32 dts] [u64 rle_offset] [u32 rle_len] [u64 bitmap_offset]
+#   [u32 bitmap_len] for every picture
+# RLE data and decoded bitmaps of pictures, at blocks_offset.
+#
+# Offsets of pictures are relative to blocks_offset, bitmap_len is 0 if
+# the decoded bitmap is not stored. Pages are parsed from button segment
+# data when they are accessed, the same way as uncached menus. All
+# integers are big-endian.
+
+CACHE_MAGIC = b"IGSC"
+CACHE_VERSION = 1
+MENU_CACHE_SUFFIX = ".igscache"
+PALETTE_TABLE_SIZE = 256 * PALETTE_ENTRY_SIZE
+NO_PID = 0xffff
+
+log = logging.getLogger("menu_cache")
+
+_file_header = struct.Struct(">4sHHIQ")
+_menu_header = struct.Struct(">HHIIIBH")
+_picture_entry = struct.Struct(">HBBHHIIQIQI")
+
+
+def source_key(path, **options):
+    # Cache of a file is only valid if it still has the same size and
+    # mtime, and if it is loaded with the same options
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "options": options,
+    }
+
+
+def save_menus(path, menus, key=None):
+    # menus is a list of dicts with pid, epoch, button (pts, dts, data),
+    # palettes (list of tables) and pictures (list of dicts with picture
+    # attributes, rle_bitmap_data and picture_data, which may be None)
+    key_data = json.dumps(key, sort_keys=True).encode("utf-8")
+    tables = bytearray()
+    blocks = []
+    blocks_size = 0
+
+    def _add_block(data):
+        nonlocal blocks_size
+        if data is None:
+            return 0, 0
+
+        offset = blocks_size
+        blocks.append(data)
+        blocks_size += len(data)
+        return offset, len(data)
+
+    for menu in menus:
+        pts, dts, button_data = menu["button"]
+        tables += _menu_header.pack(
+            NO_PID if menu["pid"] is None else menu["pid"], menu["epoch"],
+            pts, dts, len(button_data), len(menu["palettes"]),
+            len(menu["pictures"]),
+        )
+        tables += button_data
+        for table in menu["palettes"]:
+            assert len(table) == PALETTE_TABLE_SIZE
+            tables += table
+
+        for pic in menu["pictures"]:
+            rle_offset, rle_len = _add_block(pic["rle_bitmap_data"])
+            bitmap_offset, bitmap_len = _add_block(pic["picture_data"])
+            tables += _picture_entry.pack(
+                pic["id"], pic["ver"], pic["seq_desc"],
+                pic["width"], pic["height"], pic["pts"], pic["dts"],
+                rle_offset, rle_len, bitmap_offset, bitmap_len,
+            )
+
+    blocks_offset = _file_header.size + len(key_data) + len(tables)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(_file_header.pack(
+            CACHE_MAGIC, CACHE_VERSION, len(menus), len(key_data),
+            blocks_offset,
+        ))
+        f.write(key_data)
+        f.write(tables)
+        for block in blocks:
+            f.write(block)
+
+    os.replace(temp_path, path)
+    log.info("Saved %d menus to %s", len(menus), path)
+
+
+def load_menus(path, key=None):
+    # Returns list of (pid, epoch, segments), or None if the cache doesn't
+    # exist, is broken, or doesn't match key (if it is given). Data in
+    # segments are memoryviews of the mmapped file. Picture segments have
+    # picture_data set to the decoded bitmap if it is stored.
+    try:
+        with open(path, "rb") as f:
+            data = memoryview(mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ,
+            ))
+    except (OSError, ValueError):
+        return None
+
+    try:
+        return _load_menus(data, path, key)
+    except (struct.error, ValueError, EOFError, IndexError):
+        log.warning("Ignoring broken cache %s", path)
+        return None
+
+
+def _load_menus(data, path, key):
+    magic, version, menu_count, key_len, blocks_offset = \
+        _file_header.unpack_from(data)
+    offset = _file_header.size
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        return None
+
+    saved_key = json.loads(bytes(data[offset:offset + key_len]).decode())
+    offset += key_len
+    if key is not None and saved_key != json.loads(json.dumps(key)):
+        log.info("Ignoring stale cache %s", path)
+        return None
+
+    def _block(block_offset, length):
+        start = blocks_offset + block_offset
+        if start + length > len(data):
+            raise EOFError()
+
+        return data[start:start + length]
+
+    ret = []
+    for _ in range(menu_count):
+        pid, epoch, pts, dts, button_len, palette_count, picture_count = \
+            _menu_header.unpack_from(data, offset)
+        offset += _menu_header.size
+
+        button_data = data[offset:offset + button_len]
+        offset += button_len
+        button_seg = {
+            "pts": pts,
+            "dts": dts,
+            "seg_type": BUTTON_SEGMENT,
+            "raw_data": button_data,
+        }
+        button_seg.update(parse_button_data(button_data))
+        segments = [button_seg]
+
+        for _ in range(palette_count):
+            segments.append({
+                "seg_type": PALETTE_SEGMENT,
+                "palette_entries": data[offset:offset + PALETTE_TABLE_SIZE],
+            })
+            offset += PALETTE_TABLE_SIZE
+
+        for _ in range(picture_count):
+            (picture_id, ver, seq_desc, width, height, pts, dts,
+                rle_offset, rle_len, bitmap_offset, bitmap_len) = \
+                _picture_entry.unpack_from(data, offset)
+            offset += _picture_entry.size
+
+            segments.append({
+                "pts": pts,
+                "dts": dts,
+                "seg_type": PICTURE_SEGMENT,
+                "raw_data": None,
+                "id": picture_id,
+                "ver": ver,
+                "seq_desc": seq_desc,
+                "width": width,
+                "height": height,
+                "rle_bitmap_data": _block(rle_offset, rle_len),
+                "picture_data": (_block(bitmap_offset, bitmap_len)
+                                 if bitmap_len else None),
+            })
+
+        ret.append((None if pid == NO_PID else pid, epoch, segments))
+
+    log.info("Loaded %d menus from %s", len(ret), path)
+    return ret
@@ -1,150 +1,653 @@
 import logging
 import os
-from copy import deepcopy
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from . import stats
+from .ts_index import PacketIndex, INDEX_SUFFIX
+from .picture_cache import picture_key
+from . import menu_cache
 from .parser import (
-    igs_decoded_segments, m2ts_igs_stream,
-    BUTTON_SEGMENT, PICTURE_SEGMENT, PALETTE_SEGMENT,
+    igs_joined_segments, m2ts_igs_stream, first_display_set,
+    detect_container, igs_raw_segments, m2ts_igs_pid_segments,
+    epoch_display_sets,
+    decode_rle_data,
+    BUTTON_SEGMENT, PICTURE_SEGMENT, PALETTE_SEGMENT, PALETTE_ENTRY_SIZE,
 )
 
 
-class Palette(dict):
+class Palette(Mapping):
+    # Colors are stored in a 256x5 table in the same layout as palette
+    # segments, i.e. [u8 color_id] [u8 y] [u8 cr] [u8 cb] [u8 alpha].
+    # Mapping interface returns a dict for every color.
     def __init__(self, seg):
         log = logging.getLogger("model.Palette")
         log.info("Creating palette...")
-        for color in seg["palette"]:
-            assert color["color_id"] not in self
-            self[color["color_id"]] = color
-
-        for i in range(256):
-            if i not in self:
-                if i < 255:
-                    # Seems #255 never exists
-                    log.debug("Color entry #{} does not exist".format(i))
-
-                self[i] = {
-                    "color_id": i,
-                    "y": 16,
-                    "cb": 128,
-                    "cr": 128,
-                    "alpha": 0,
-                }
+        entries = seg["palette_entries"]
+        color_ids = entries[::PALETTE_ENTRY_SIZE]
+        assert len(set(color_ids)) == len(color_ids)
+
+        self.table = bytearray(256 * PALETTE_ENTRY_SIZE)
+        self.table[0::PALETTE_ENTRY_SIZE] = bytes(range(256))
+        self.table[1::PALETTE_ENTRY_SIZE] = b"\x10" * 256
+        self.table[2::PALETTE_ENTRY_SIZE] = b"\x80" * 256
+        self.table[3::PALETTE_ENTRY_SIZE] = b"\x80" * 256
+        for i, color_id in enumerate(color_ids):
+            entry_start = i * PALETTE_ENTRY_SIZE
+            table_start = color_id * PALETTE_ENTRY_SIZE
+            self.table[table_start:table_start + PALETTE_ENTRY_SIZE] = \
+                entries[entry_start:entry_start + PALETTE_ENTRY_SIZE]
+
+        # Seems #255 never exists
+        for i in sorted(set(range(255)) - set(color_ids)):
+            log.debug("Color entry #{} does not exist".format(i))
+
+    def __getitem__(self, color_id):
+        if not 0 <= color_id < 256:
+            raise KeyError(color_id)
+
+        start = color_id * PALETTE_ENTRY_SIZE
+        _, y, cr, cb, alpha = self.table[start:start + PALETTE_ENTRY_SIZE]
+        return {
+            "color_id": color_id,
+            "y": y,
+            "cr": cr,
+            "cb": cb,
+            "alpha": alpha,
+        }
+
+    def __iter__(self):
+        return iter(range(256))
+
+    def __len__(self):
+        return 256
 
     def __str__(self):
         return "<Palette ({} colors)>".format(len(self))
 
 
 class Picture:
+    # RLE data is kept compressed, picture_data is decoded on first access,
+    # or loaded from cache (a PictureCache) if it is set
+    _picture_data = None
+    _cache_key = None
+    cache = None
+
     def __init__(self, seg):
         self.__dict__.update(seg)
         del self.raw_data
         del self.seg_type
 
+    @property
+    def cache_key(self):
+        if self._cache_key is None:
+            self._cache_key = picture_key(
+                self.rle_bitmap_data, self.width, self.height,
+            )
+
+        return self._cache_key
+
+    @property
+    def picture_data(self):
+        if self._picture_data is None and not self._load_cached():
+            self._set_decoded(decode_rle_data(
+                self.rle_bitmap_data, self.width, self.height,
+            ))
+
+        return self._picture_data
+
+    def _load_cached(self):
+        if self.cache is None:
+            return False
+
+        data = self.cache.get(self.cache_key)
+        if data is None or len(data) != self.width * self.height:
+            return False
+
+        self._picture_data = data
+        return True
+
+    def _set_decoded(self, data):
+        self._picture_data = data
+        if self.cache is not None:
+            self.cache.put(self.cache_key, data)
+
+    def unload(self):
+        # Drops decoded data, it will be decoded again when needed
+        self._picture_data = None
+
     def __str__(self):
         return "<Picture #{0.id} ({0.width}x{0.height})>".format(self)
 
 
+def _id_of(obj):
+    # Reverse of _find_button and _find_picture
+    return 0xffff if obj is None else obj.id
+
+
 class Button:
+    __slots__ = (
+        "id", "v", "f", "auto_action", "x", "y", "navigation", "states",
+        "commands",
+    )
+
     def __init__(self, raw_data):
-        self.__dict__.update(raw_data)
-        self.raw_data = deepcopy(raw_data)
+        for name in self.__slots__:
+            setattr(self, name, raw_data[name])
+
+    @property
+    def raw_data(self):
+        # Built on demand, navigation and pictures are converted back to IDs
+        return {
+            "id": self.id,
+            "v": self.v,
+            "f": self.f,
+            "auto_action": self.auto_action,
+            "x": self.x,
+            "y": self.y,
+            "navigation": {
+                key: value if isinstance(value, int) else _id_of(value)
+                for key, value in self.navigation.items()
+            },
+            "states": {
+                name: {
+                    key: value if isinstance(value, int) else _id_of(value)
+                    for key, value in state.items()
+                }
+                for name, state in self.states.items()
+            },
+            "commands": list(self.commands),
+        }
 
     def __str__(self):
         return "<Button #{0.id} ({0.x}, {0.y})>".format(self)
 
 
 class BOG:
+    __slots__ = ("def_button", "buttons")
+
     def __init__(self, raw_data):
-        self.__dict__.update(raw_data)
-        self.raw_data = deepcopy(raw_data)
-        self.buttons = {x["id"]: Button(x) for x in self.buttons}
-        self.def_button = self.buttons[self.def_button]
+        self.buttons = {x["id"]: Button(x) for x in raw_data["buttons"]}
+        self.def_button = self.buttons[raw_data["def_button"]]
+
+    @property
+    def raw_data(self):
+        return {
+            "def_button": self.def_button.id,
+            "buttons": [x.raw_data for x in self.buttons.values()],
+        }
 
     def __str__(self):
         return "<BOG ({} buttons)>".format(len(self.buttons))
 
 
+def _raw_effects(effects):
+    return {
+        "windows": effects["windows"],
+        "effects": [
+            {
+                "duration": effect["duration"],
+                "palette": effect["palette_id"],
+                "objects": effect["objects"],
+            }
+            for effect in effects["effects"]
+        ],
+    }
+
+
 class Page:
-    def __init__(self, raw_data):
-        self.__dict__.update(raw_data)
-        self.raw_data = deepcopy(raw_data)
-        self.bogs = [BOG(x) for x in self.bogs]
-        self.def_button = self._find_button(self.def_button)
-        self.def_activated = self._find_button(self.def_activated)
+    # palette and palette of effects are replaced with Palette objects by
+    # IGSMenu, their IDs are kept in palette_id.
+    # buttons maps ID to Button for all BOGs. navigation maps button ID to
+    # IDs of buttons that can be reached from it in one step, reachable is
+    # the set of button IDs that can be reached from the default button
+    # (or from default buttons of BOGs if the page has none).
+    __slots__ = (
+        "id", "uo", "in_effects", "out_effects", "framerate_divider",
+        "def_button", "def_activated", "palette", "palette_id", "bogs",
+        "buttons", "navigation", "reachable",
+    )
 
+    def __init__(self, raw_data):
+        self.id = raw_data["id"]
+        self.uo = raw_data["uo"]
+        self.in_effects = raw_data["in_effects"]
+        self.out_effects = raw_data["out_effects"]
+        self.framerate_divider = raw_data["framerate_divider"]
+        self.palette = self.palette_id = raw_data["palette"]
+        for effect in self.in_effects["effects"] + \
+                self.out_effects["effects"]:
+            effect["palette_id"] = effect["palette"]
+
+        self.bogs = [BOG(x) for x in raw_data["bogs"]]
+        self.buttons = {}
         for bog in self.bogs:
-            for button in bog.buttons.values():
-                nav = button.navigation
-                for nav_key in list(nav.keys()):
-                    nav[nav_key] = self._find_button(nav[nav_key])
+            for button_id, button in bog.buttons.items():
+                self.buttons.setdefault(button_id, button)
+
+        self.def_button = self._find_button(raw_data["def_button"])
+        self.def_activated = self._find_button(raw_data["def_activated"])
+
+        self.navigation = {}
+        for button_id, button in self.buttons.items():
+            nav = button.navigation
+            for nav_key in list(nav.keys()):
+                nav[nav_key] = self._find_button(nav[nav_key])
+
+            self.navigation[button_id] = tuple(sorted({
+                x.id for x in nav.values()
+                if x is not None and x.id != button_id
+            }))
+
+        self.reachable = self._find_reachable()
+
+    @property
+    def raw_data(self):
+        return {
+            "id": self.id,
+            "uo": self.uo,
+            "in_effects": _raw_effects(self.in_effects),
+            "out_effects": _raw_effects(self.out_effects),
+            "framerate_divider": self.framerate_divider,
+            "def_button": _id_of(self.def_button),
+            "def_activated": _id_of(self.def_activated),
+            "palette": self.palette_id,
+            "bogs": [x.raw_data for x in self.bogs],
+        }
 
     def _find_button(self, button_id):
         if button_id == 0xffff:
             return None
 
-        for bog in self.bogs:
-            for button in bog.buttons.values():
-                if button.id == button_id:
-                    return button
+        button = self.buttons.get(button_id)
+        if button is None:
+            raise KeyError("Button not found")
+
+        return button
+
+    def _find_reachable(self):
+        if self.def_button is not None:
+            pending = [self.def_button.id]
+        else:
+            pending = [bog.def_button.id for bog in self.bogs]
+
+        ret = set(pending)
+        while pending:
+            for next_id in self.navigation[pending.pop()]:
+                if next_id not in ret:
+                    ret.add(next_id)
+                    pending.append(next_id)
 
-        raise KeyError("Button not found")
+        return frozenset(ret)
 
     def __str__(self):
         return "<Page #{} ({} BOGs)>".format(self.id, len(self.bogs))
 
 
+class Pages(Mapping):
+    # Maps page ID to Page, pages are built on first access
+    def __init__(self, raw_pages, build_page):
+        self._raw_pages = raw_pages
+        self._positions = {
+            page_id: i for i, page_id in enumerate(raw_pages.ids)
+        }
+        self._build_page = build_page
+        self._pages = {}
+
+    def __getitem__(self, page_id):
+        page = self._pages.get(page_id)
+        if page is None:
+            position = self._positions[page_id]
+            page = self._build_page(self._raw_pages[position])
+            self._pages[page_id] = page
+
+        return page
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __str__(self):
+        return "<Pages ({} pages, {} built)>".format(
+            len(self), len(self._pages),
+        )
+
+
+def _drain(items):
+    # Yields items of a list and removes them from it, so that they can be
+    # freed once the consumer is done with them
+    items.reverse()
+    while items:
+        yield items.pop()
+
+
 class IGSMenu:
-    def __init__(self, stream_or_filename):
+    pid = None
+    epoch = 0
+    decode_workers = 1
+    picture_cache = None
+
+    def __init__(
+        self, stream_or_filename,
+        use_index=False, scan_workers=1,
+        start=None, end=None, decode_workers=1, picture_cache=None,
+    ):
+        # Loads the first menu of the first IGS stream, use load_all for
+        # menus of later epochs and other streams.
+        # start and end are PTS in 90kHz units, only used for M2TS files.
+        # decode_workers is the number of processes used by
+        # decode_pictures, decoded pictures are looked up in and saved to
+        # picture_cache if it is given.
+        options = {
+            "decode_workers": decode_workers,
+            "picture_cache": picture_cache,
+        }
         if isinstance(stream_or_filename, str):
             with open(stream_or_filename, "rb") as f:
-                stream = f
                 if os.path.splitext(stream_or_filename)[1].lower() == ".m2ts":
-                    stream = m2ts_igs_stream(stream)
-
-                self.__init__(stream)
+                    self._load(
+                        f, "m2ts",
+                        index_path=(stream_or_filename + INDEX_SUFFIX
+                                    if use_index else None),
+                        scan_workers=scan_workers,
+                        start=start,
+                        end=end,
+                        **options
+                    )
+                else:
+                    self._load(f, "mnu", **options)
 
             return
 
-        self._fill_data(list(igs_decoded_segments(stream_or_filename)))
+        self._load(stream_or_filename, "mnu", **options)
 
-    def __str__(self):
-        return "<IGSMenu ({} pages)>".format(len(self.pages))
+    @classmethod
+    def load_all(
+        cls, stream_or_filename, container="auto",
+        use_index=False, scan_workers=1, start=None, end=None,
+        decode_workers=1, picture_cache=None,
+    ):
+        # Returns menus of all epochs in all IGS streams, read in a single
+        # pass. Each of them has pid (None for menu files) and epoch set.
+        if isinstance(stream_or_filename, str):
+            with open(stream_or_filename, "rb") as f:
+                is_m2ts = (os.path.splitext(stream_or_filename)[1].lower() ==
+                           ".m2ts")
+                return cls._load_all(
+                    f, "m2ts" if is_m2ts else "mnu",
+                    index_path=(stream_or_filename + INDEX_SUFFIX
+                                if use_index else None),
+                    scan_workers=scan_workers,
+                    start=start,
+                    end=end,
+                    decode_workers=decode_workers,
+                    picture_cache=picture_cache,
+                )
+
+        if container == "auto":
+            container, stream_or_filename = \
+                detect_container(stream_or_filename)
+
+        return cls._load_all(
+            stream_or_filename, container,
+            scan_workers=scan_workers,
+            start=start,
+            end=end,
+            decode_workers=decode_workers,
+            picture_cache=picture_cache,
+        )
+
+    @classmethod
+    def _load_all(
+        cls, stream, container,
+        index_path=None, scan_workers=1, start=None, end=None,
+        decode_workers=1, picture_cache=None,
+    ):
+        # Menus are built as soon as their display set is complete, other
+        # display sets are dropped as they are read. Menu files have a
+        # single stream with PID None.
+        index = None
+        if container == "mnu":
+            pid_segments = ((None, seg) for seg in igs_raw_segments(stream))
+        elif container == "m2ts":
+            if index_path and start is None and end is None:
+                index = PacketIndex.load(stream, index_path)
+
+            pid_segments = m2ts_igs_pid_segments(
+                stream, index=index, workers=scan_workers,
+                start=start, end=end,
+            )
+        else:
+            raise ValueError("Unknown container: {}".format(container))
+
+        pid_menus = {}
+        for pid, display_set in epoch_display_sets(pid_segments):
+            menus = pid_menus.setdefault(pid, [])
+            menu = cls.__new__(cls)
+            menu.pid = pid
+            menu.epoch = len(menus)
+            menu.decode_workers = decode_workers
+            menu.picture_cache = picture_cache
+            menu._fill_data(_drain(display_set))
+            menus.append(menu)
+
+        if index is not None:
+            index.save(index_path)
+
+        ret = []
+        for pid in sorted(pid_menus, key=lambda x: x or 0):
+            ret.extend(pid_menus[pid])
+
+        return ret
+
+    @classmethod
+    def load_cache_all(
+        cls, path, key=None, decode_workers=1, picture_cache=None,
+    ):
+        # Returns menus saved by save_cache_all, or None if the cache
+        # doesn't exist or doesn't match key
+        cached = menu_cache.load_menus(path, key)
+        if cached is None:
+            return None
 
-    def _fill_data(self, parsed_data):
-        self.palettes = [
-            Palette(seg)
-            for seg in parsed_data
-            if seg["seg_type"] == PALETTE_SEGMENT
-        ]
-        self.pictures = {
-            seg["id"]: Picture(seg)
-            for seg in parsed_data
-            if seg["seg_type"] == PICTURE_SEGMENT
+        ret = []
+        for pid, epoch, segments in cached:
+            menu = cls.__new__(cls)
+            menu.pid = pid
+            menu.epoch = epoch
+            menu.decode_workers = decode_workers
+            menu.picture_cache = picture_cache
+            menu._fill_data(_drain(segments))
+            ret.append(menu)
+
+        return ret
+
+    @classmethod
+    def load_cache(cls, path, **kwargs):
+        # Keyword arguments are the same as load_cache_all
+        menus = cls.load_cache_all(path, **kwargs)
+        if not menus:
+            raise ValueError("Invalid menu cache: {}".format(path))
+
+        return menus[0]
+
+    @staticmethod
+    def save_cache_all(menus, path, key=None, include_bitmaps=False):
+        # Saves menus to a binary cache file. RLE data of pictures is always
+        # saved, decoded bitmaps only if include_bitmaps is set.
+        menu_cache.save_menus(path, [
+            menu._cache_data(include_bitmaps) for menu in menus
+        ], key)
+
+    def save_cache(self, path, include_bitmaps=False):
+        self.save_cache_all([self], path, include_bitmaps=include_bitmaps)
+
+    def _cache_data(self, include_bitmaps):
+        if include_bitmaps:
+            self.decode_pictures()
+
+        return {
+            "pid": self.pid,
+            "epoch": self.epoch,
+            "button": (self.pts, self.dts, self.pages._raw_pages.data),
+            "palettes": [palette.table for palette in self.palettes],
+            "pictures": [
+                {
+                    "id": pic.id,
+                    "ver": pic.ver,
+                    "seq_desc": pic.seq_desc,
+                    "width": pic.width,
+                    "height": pic.height,
+                    "pts": pic.pts,
+                    "dts": pic.dts,
+                    "rle_bitmap_data": pic.rle_bitmap_data,
+                    "picture_data": (pic.picture_data
+                                     if include_bitmaps else None),
+                }
+                for pic in self.pictures.values()
+            ],
         }
-        button_segs = [x for x in parsed_data
-                       if x["seg_type"] == BUTTON_SEGMENT]
 
-        assert len(button_segs) == 1
-        button_seg = button_segs[0]
+    @classmethod
+    def from_stream(cls, stream, container="auto", **kwargs):
+        # Stream doesn't need to be seekable, container is one of "m2ts",
+        # "mnu" and "auto". Keyword arguments are the same as __init__,
+        # except use_index.
+        if container == "auto":
+            container, stream = detect_container(stream)
+
+        if container not in ("m2ts", "mnu"):
+            raise ValueError("Unknown container: {}".format(container))
+
+        ret = cls.__new__(cls)
+        ret._load(stream, container, **kwargs)
+        return ret
+
+    def _load(
+        self, stream, container,
+        index_path=None, scan_workers=1,
+        start=None, end=None, decode_workers=1, picture_cache=None,
+    ):
+        self.decode_workers = decode_workers
+        self.picture_cache = picture_cache
+        if container == "mnu":
+            self._fill_data(igs_joined_segments(stream))
+            return
+
+        index = None
+        if index_path and start is None and end is None:
+            # Index of a partial scan is not reusable
+            index = PacketIndex.load(stream, index_path)
+
+        segments = igs_joined_segments(m2ts_igs_stream(
+            stream, index=index, workers=scan_workers,
+            start=start, end=end,
+        ))
+        # Menus are usually in the first few seconds, don't read the whole
+        # file for them
+        self._fill_data(first_display_set(segments))
+        if index is not None:
+            index.save(index_path)
+
+    def __str__(self):
+        if self.pid is None:
+            return "<IGSMenu ({} pages)>".format(len(self.pages))
+
+        return "<IGSMenu PID {} epoch {} ({} pages)>".format(
+            self.pid, self.epoch, len(self.pages),
+        )
+
+    @stats.timed("model")
+    def _fill_data(self, segments):
+        # Segments are consumed one at a time, only the button segment
+        # keeps its raw data (pages are parsed from it on demand)
+        self.palettes = []
+        self.pictures = {}
+        button_seg = None
+        for seg in segments:
+            seg_type = seg["seg_type"]
+            if seg_type == PALETTE_SEGMENT:
+                self.palettes.append(Palette(seg))
+            elif seg_type == PICTURE_SEGMENT:
+                # Only set by menu_cache
+                picture_data = seg.pop("picture_data", None)
+                pic = Picture(seg)
+                pic.cache = self.picture_cache
+                pic._picture_data = picture_data
+                self.pictures[pic.id] = pic
+            elif seg_type == BUTTON_SEGMENT:
+                assert button_seg is None
+                button_seg = seg
+
+        assert button_seg is not None
         self.__dict__.update(button_seg)
         del self.raw_data
         del self.seg_type
-        self.pages = {x["id"]: Page(x) for x in self.pages}
-        for page in self.pages.values():
-            page.palette_id = page.palette
-            page.palette = self.palettes[page.palette_id]
-            for subeffect in (page.in_effects["effects"] +
-                              page.out_effects["effects"]):
-                subeffect["palette"] = self.palettes[subeffect["palette"]]
-
-            for bog in page.bogs:
-                for button in bog.buttons.values():
-                    for states in button.states.values():
-                        states["start"] = self._find_picture(states["start"])
-                        states["stop"] = self._find_picture(states["stop"])
+        self.pages = Pages(self.pages, self._build_page)
+
+    @stats.timed("model")
+    def _build_page(self, raw_page):
+        page = Page(raw_page)
+        page.palette = self.palettes[page.palette_id]
+        for subeffect in (page.in_effects["effects"] +
+                          page.out_effects["effects"]):
+            subeffect["palette"] = self.palettes[subeffect["palette"]]
+
+        for bog in page.bogs:
+            for button in bog.buttons.values():
+                for states in button.states.values():
+                    states["start"] = self._find_picture(states["start"])
+                    states["stop"] = self._find_picture(states["stop"])
+
+        return page
+
+    def find_button(self, page_id, button_id):
+        # Only builds the page that is asked for
+        return self.pages[page_id].buttons[button_id]
 
     def _find_picture(self, picture_id):
         if picture_id == 0xffff:
             return None
 
         return self.pictures[picture_id]
+
+    def decode_pictures(self, pictures=None, executor=None):
+        # Decodes pictures (all of them by default) ahead of use. With
+        # decode_workers > 1 they are decoded in a process pool, pass
+        # executor to reuse an existing one.
+        if pictures is None:
+            pictures = self.pictures.values()
+
+        pictures = [
+            pic for pic in pictures
+            if pic._picture_data is None and not pic._load_cached()
+        ]
+        if executor is None:
+            if self.decode_workers <= 1 or len(pictures) < 2:
+                for pic in pictures:
+                    pic.picture_data
+
+                return
+
+            with ProcessPoolExecutor(
+                max_workers=self.decode_workers,
+            ) as executor:
+                return self.decode_pictures(pictures, executor)
+
+        futures = {
+            executor.submit(
+                decode_rle_data, bytes(pic.rle_bitmap_data),
+                pic.width, pic.height,
+            ): pic
+            for pic in pictures
+        }
+        with stats.stage("rle_decode"):
+            for future in as_completed(futures):
+                futures[future]._set_decoded(future.result())
+
+        stats.add(
+            "rle_decode", len(futures),
+            sum(pic.width * pic.height for pic in pictures),
+        )
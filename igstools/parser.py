@@ -5,54 +5,167 @@
 import io
 import logging
 import functools
+import struct
+from collections.abc import Sequence
 
+from . import stats
 from .utils import (
     unpack_from_stream as _unpack_from_stream,
-    eof_aware_read as _eof_aware_read,
     log_dict,
+    PrefixedStream,
+)
+from .ts_reader import (
+    igs_demuxer_iter, igs_pid_demuxer_iter,
+    BLURAY_HEADER_SIZE, M2TS_PACKET_SIZE, SYNC_BYTE,
 )
-from .ts_reader import igs_demuxer_iter
 
 PALETTE_SEGMENT = 0x14
 PICTURE_SEGMENT = 0x15
 BUTTON_SEGMENT  = 0x18 # noqa
 DISPLAY_SEGMENT = 0x80
 
+PALETTE_ENTRY_SIZE = 5
+
+COMPOSITION_STATE_EPOCH_START = 0x80
+
+CONTAINER_PROBE_SIZE = BLURAY_HEADER_SIZE + M2TS_PACKET_SIZE + 1
+
 log = logging.getLogger("parser")
+_segment_header = struct.Struct(">2sIIBH")
+_picture_header = struct.Struct(">HBB")
+_picture_info = struct.Struct(">BBBHH")
+_button_segment_header = struct.Struct(">HHBHBBBBBB")
+_page_header = struct.Struct(">BBQ")
+_effect_window = struct.Struct(">BHHHH")
+_effect = struct.Struct(">5B")
+_effect_object = struct.Struct(">4H")
+_page_info = struct.Struct(">BHHBB")
+_bog_header = struct.Struct(">HB")
+_button = struct.Struct(">HHB" + "H" * 15)
+_command = struct.Struct(">III")
+_u16 = struct.Struct(">H")
+_single_bytes = [bytes((i,)) for i in range(256)]
 _log_dict = functools.partial(log_dict, log)
 
 
-def m2ts_igs_stream(stream):
+def detect_container(stream):
+    # Returns container type of the stream and a stream that reads from
+    # the same position, the original stream is returned if it's seekable
+    head = b""
+    while len(head) < CONTAINER_PROBE_SIZE:
+        chunk = stream.read(CONTAINER_PROBE_SIZE - len(head))
+        if not chunk:
+            break
+
+        head += chunk
+
+    if getattr(stream, "seekable", lambda: False)():
+        stream.seek(-len(head), io.SEEK_CUR)
+    else:
+        stream = PrefixedStream(head, stream)
+
+    if head[:2] == b"IG":
+        return "mnu", stream
+
+    second_sync = BLURAY_HEADER_SIZE + M2TS_PACKET_SIZE
+    if (head[BLURAY_HEADER_SIZE:BLURAY_HEADER_SIZE + 1] == SYNC_BYTE and
+            head[second_sync:second_sync + 1] in (SYNC_BYTE, b"")):
+        return "m2ts", stream
+
+    raise ValueError("Unknown container format")
+
+
+def m2ts_igs_stream(stream, **kwargs):
     class FakeStream:
+        # Reassembly buffer of demuxed payloads. Consumed data is only
+        # dropped once it makes up the larger part of the buffer, so reads
+        # are amortized O(1) regardless of how small they are.
         def __init__(self):
-            self.iterator = igs_demuxer_iter(stream)
-            self.last_buffer = b""
+            self.iterator = igs_demuxer_iter(stream, **kwargs)
+            self.buffer = bytearray()
+            self.position = 0
 
-        def read(self, count):
-            assert count >= 0
-            buffer = [self.last_buffer]
-            bytes_buffered = len(self.last_buffer)
-            while bytes_buffered < count:
+        def _fill(self, count):
+            available = len(self.buffer) - self.position
+            if available >= count:
+                return available
+
+            if self.position > available:
+                del self.buffer[:self.position]
+                self.position = 0
+
+            while available < count:
                 chunk = next(self.iterator, None)
-                if not chunk:
-                    self.last_buffer = b""
-                    return b"".join(buffer)
+                if chunk is None:
+                    break
 
-                buffer.append(chunk)
-                bytes_buffered += len(chunk)
+                self.buffer += chunk
+                available += len(chunk)
 
-            all_data = b"".join(buffer)
-            self.last_buffer = all_data[count:]
-            return all_data[:count]
+            return available
+
+        def readinto(self, b):
+            with memoryview(b) as target:
+                count = min(self._fill(target.nbytes), target.nbytes)
+                end = self.position + count
+                with memoryview(self.buffer) as view:
+                    target[:count] = view[self.position:end]
+
+            self.position = end
+            return count
+
+        def read(self, count):
+            assert count >= 0
+            count = min(self._fill(count), count)
+            end = self.position + count
+            with memoryview(self.buffer) as view:
+                ret = bytes(view[self.position:end])
+
+            self.position = end
+            return ret
 
     return FakeStream()
 
 
+def m2ts_igs_pid_segments(stream, **kwargs):
+    # Yields (pid, segment) of all IGS streams in a single pass, segments
+    # are the same as those from igs_raw_segments. See
+    # ts_reader.igs_pid_demuxer_iter for arguments.
+    buffers = {}
+    for pid, data in stats.timed_iter(
+        "pes", igs_pid_demuxer_iter(stream, **kwargs),
+        lambda x: len(x[1]),
+    ):
+        buffer = buffers.setdefault(pid, bytearray())
+        buffer += data
+        while len(buffer) >= _segment_header.size:
+            magic, pts, dts, seg_type, seg_length = \
+                _segment_header.unpack_from(buffer)
+            if magic != b"IG":
+                raise ValueError("Invalid segment header")
+
+            seg_end = _segment_header.size + seg_length
+            if len(buffer) < seg_end:
+                break
+
+            raw_data = bytes(buffer[_segment_header.size:seg_end])
+            del buffer[:seg_end]
+            yield pid, {
+                "pts": pts,
+                "dts": dts,
+                "seg_type": seg_type,
+                "raw_data": raw_data,
+            }
+
+    if any(buffers.values()):
+        raise EOFError()
+
+
 def igs_raw_segments(stream):
     # All integers are in big-endian
     # ["IG"] [u32 pts] [u32 dts] [u8 seg_type] [u16 seg_length]
     while True:
-        header_tuple = _unpack_from_stream(">2sIIBH", stream)
+        header_tuple = _unpack_from_stream(_segment_header.format, stream)
         if not header_tuple:
             return
 
@@ -60,8 +173,14 @@ def igs_raw_segments(stream):
         if magic != b"IG":
             raise ValueError("Invalid segment header")
 
-        raw_data = stream.read(seg_length)
-        if len(raw_data) < seg_length:
+        if hasattr(stream, "readinto"):
+            raw_data = bytearray(seg_length)
+            bytes_read = stream.readinto(raw_data)
+        else:
+            raw_data = stream.read(seg_length)
+            bytes_read = len(raw_data)
+
+        if bytes_read < seg_length:
             raise EOFError()
 
         yield {
@@ -72,37 +191,53 @@ def igs_raw_segments(stream):
         }
 
 
-def parse_palette_segment(stream):
-    ret = {
-        "palette": [],
-    }
+def _segment_parser(parse_data):
+    # Makes a parser of segment data from a stream out of a parser that
+    # works on the data directly
+    @functools.wraps(parse_data)
+    def _parse_stream(stream):
+        return parse_data(memoryview(stream.read()))
 
-    # 2 unknown bytes, not id
-    stream.read(2)
+    return _parse_stream
 
-    while True:
-        entry_data = _unpack_from_stream("BBBBB", stream)
-        if not entry_data:
-            break
 
-        color_id, y, cr, cb, alpha = entry_data
-        ret["palette"].append({
-            "color_id": color_id,
-            "y": y,
-            "cr": cr,
-            "cb": cb,
-            "alpha": alpha,
-        })
+def _eof_on_short_data(func):
+    @functools.wraps(func)
+    def _wrapper(data):
+        try:
+            return func(data)
+        except (struct.error, IndexError):
+            raise EOFError()
+
+    return _wrapper
+
 
-    log.debug("Palette segment, {} colors".format(len(ret["palette"])))
+@_eof_on_short_data
+def parse_palette_data(data):
+    # 2 unknown bytes, not id
+    # Entries are kept in raw form:
+    # [u8 color_id] [u8 y] [u8 cr] [u8 cb] [u8 alpha]
+    entries = bytes(data[2:])
+    if len(entries) % PALETTE_ENTRY_SIZE:
+        raise EOFError()
+
+    ret = {
+        "palette_entries": entries,
+    }
+
+    log.debug("Palette segment, {} colors".format(
+        len(entries) // PALETTE_ENTRY_SIZE,
+    ))
     return ret
 
 
-def parse_picture_segment(stream):
+@_eof_on_short_data
+def parse_picture_data(data):
     # [u16 oid] [u8 ver] [u8 seq_desc] [u24 rle_bitmap_len * !]
     # [u16 width !] [u16 height !]
     # Note: The last 3 elements are not present in continued segments
-    picture_id, ver, seq_desc = _unpack_from_stream(">HBB", stream)
+    picture_id, ver, seq_desc = _picture_header.unpack_from(data)
+    offset = _picture_header.size
 
     ret = {
         "id": picture_id,
@@ -111,7 +246,9 @@ def parse_picture_segment(stream):
         "is_continuation": not bool(seq_desc & 0x80),
     }
     if not ret["is_continuation"]:
-        len1, len2, len3, width, height = _unpack_from_stream(">BBBHH", stream)
+        len1, len2, len3, width, height = \
+            _picture_info.unpack_from(data, offset)
+        offset += _picture_info.size
 
         rle_bitmap_len = (len1 << 16) | (len2 << 8) | len3
 
@@ -123,19 +260,173 @@ def parse_picture_segment(stream):
             "rle_bitmap_len": rle_bitmap_len,
         })
 
-    ret.update({"rle_bitmap_data": stream.read()})
+    ret.update({"rle_bitmap_data": data[offset:]})
 
     _log_dict(ret, "Picture segment, ")
     return ret
 
 
-def parse_button_segment(stream):
+def _parse_effects(data, offset):
+    ret = {
+        "windows": {},
+        "effects": [],
+    }
+    window_count = data[offset]
+    offset += 1
+    for _ in range(window_count):
+        # [u8 id] [u16 x] [u16 y] [u16 width] [u16 height]
+        window_id, x, y, width, height = \
+            _effect_window.unpack_from(data, offset)
+        offset += _effect_window.size
+
+        assert window_id not in ret["windows"]
+        effect_window = {
+            "id": window_id,
+            "x": x,
+            "y": y,
+            "width": width,
+            "height": height,
+        }
+        _log_dict(effect_window, "Effect window, ")
+        ret["windows"][window_id] = effect_window
+
+    effect_count = data[offset]
+    offset += 1
+    for _ in range(effect_count):
+        # [u24 ?! duration] [u8 palette] [u8 count of object]
+        dur1, dur2, dur3, palette, num_objects = \
+            _effect.unpack_from(data, offset)
+        offset += _effect.size
+
+        cur_effect = {
+            "duration": (dur1 << 16) | (dur2 << 8) | dur3,
+            "palette": palette,
+            "objects": [],
+        }
+        _log_dict(cur_effect, "Effect, ")
+        for _ in range(num_objects):
+            obj_id, window, x, y = _effect_object.unpack_from(data, offset)
+            offset += _effect_object.size
+
+            obj = {
+                "id": obj_id,
+                "window": ret["windows"][window],
+                "x": x,
+                "y": y,
+            }
+            _log_dict(obj, "Object, ")
+            cur_effect["objects"].append(obj)
+
+        ret["effects"].append(cur_effect)
+
+    return ret, offset
+
+
+def _parse_button(data, offset):
+    # f is u8, others are all u16
+    button_id, v, f, x, y, nu, nd, nl, nr, \
+        picstart_normal, picstop_normal, flags_normal, \
+        picstart_selected, picstop_selected, flags_selected, \
+        picstart_activated, picstop_activated, cmds_count = \
+        _button.unpack_from(data, offset)
+    offset += _button.size
+
+    # 3 u32 for each command
+    commands = [
+        _command.unpack_from(data, offset + i * _command.size)
+        for i in range(cmds_count)
+    ]
+    offset += cmds_count * _command.size
+    if offset > len(data):
+        raise EOFError()
+
+    ret = {
+        "id": button_id,
+        "v": v,
+        "f": f,
+        "auto_action": bool(f & 128),
+        "x": x,
+        "y": y,
+        "navigation": {
+            "up": nu,
+            "down": nd,
+            "left": nl,
+            "right": nr,
+        },
+        "states": {
+            "normal": {
+                "start": picstart_normal,
+                "stop": picstop_normal,
+                "flags": flags_normal,
+            },
+            "selected": {
+                "start": picstart_selected,
+                "stop": picstop_selected,
+                "flags": flags_selected,
+            },
+            "activated": {
+                "start": picstart_activated,
+                "stop": picstop_activated,
+            },
+        },
+        "commands": commands,
+    }
+    _log_dict(ret, "Button, ")
+    return ret, offset
+
+
+def _parse_page(data, offset):
+    # [u8 page_id] [u8 ?] [u64 uo]
+    page_id, _, uo = _page_header.unpack_from(data, offset)
+    offset += _page_header.size
+
+    in_effects, offset = _parse_effects(data, offset)
+    out_effects, offset = _parse_effects(data, offset)
+
+    # [u8 framerate_divider] [u16 def_button] [u16 def_activated]
+    # [u8 palette] [u8 bog_count]
+    framerate_divider, def_button, def_activated, palette, bog_count = \
+        _page_info.unpack_from(data, offset)
+    offset += _page_info.size
+    cur_page = {
+        "id": page_id,
+        "uo": uo,
+        "in_effects": in_effects,
+        "out_effects": out_effects,
+        "framerate_divider": framerate_divider,
+        "def_button": def_button,
+        "def_activated": def_activated,
+        "palette": palette,
+        "bogs": [],
+    }
+    _log_dict(cur_page, "Page, ")
+    for _ in range(bog_count):
+        # [u16 def_button] [u8 button_count]
+        bog_def_button, button_count = _bog_header.unpack_from(data, offset)
+        offset += _bog_header.size
+        cur_bog = {
+            "def_button": bog_def_button,
+            "buttons": [],
+        }
+        _log_dict(cur_bog, "BOG, ")
+        for _ in range(button_count):
+            button, offset = _parse_button(data, offset)
+            cur_bog["buttons"].append(button)
+
+        cur_page["bogs"].append(cur_bog)
+
+    return cur_page, offset
+
+
+@_eof_on_short_data
+def parse_button_data(data):
     # Reference: http://git.videolan.org/?p=libbluray.git;a=tree;f=src/libbluray/decoders # noqa
     # [u16 width] [u16 height] [u8 framerate_id] [u16 composition_number]
     # [u8 composition_state] [u8 seq_descriptor] [u24 data_len] [u8 model_flags] # noqa
     (width, height, framerate_id, composition_number, composition_state,
         seq_descriptor, _, _, _, model_flags) = \
-        _unpack_from_stream(">HHBHBBBBBB", stream)
+        _button_segment_header.unpack_from(data)
+    offset = _button_segment_header.size
 
     ret = {
         "width": width,
@@ -145,229 +436,323 @@ def parse_button_segment(stream):
         "composition_state": composition_state,
         "seq_descriptor": seq_descriptor,
         "model_flags": model_flags,
-        "pages": [],
     }
     if (model_flags & 0x80) == 0:
-        ret["composition_timeout_pts"] = _eof_aware_read(stream, 5, True)
-        ret["selection_timeout_pts"] = _eof_aware_read(stream, 5, True)
+        ret["composition_timeout_pts"] = _read_bytes(data, offset, 5)
+        ret["selection_timeout_pts"] = _read_bytes(data, offset + 5, 5)
+        offset += 10
 
-    ret["user_timeout_duration"] = _eof_aware_read(stream, 3, True)
+    ret["user_timeout_duration"] = _read_bytes(data, offset, 3)
+    offset += 3
 
-    page_count = ord(stream.read(1))
+    page_count = data[offset]
+    offset += 1
     _log_dict(ret, "Button segment, ")
-    for i in range(page_count):
-        # [u8 page_id] [u8 ?] [u64 uo]
-        page_id, _, uo = _unpack_from_stream(">BBQ", stream)
-
-        def _read_effects():
-            ret = {
-                "windows": {},
-                "effects": [],
-            }
-            for _0 in range(ord(stream.read(1))):
-                # [u8 id] [u16 x] [u16 y] [u16 width] [u16 height]
-                window_id, x, y, width, height = \
-                    _unpack_from_stream(">BHHHH", stream)
-
-                assert window_id not in ret["windows"]
-                effect_window = {
-                    "id": window_id,
-                    "x": x,
-                    "y": y,
-                    "width": width,
-                    "height": height,
-                }
-                _log_dict(effect_window, "Effect window, ")
-                ret["windows"][window_id] = effect_window
-
-            for _0 in range(ord(stream.read(1))):
-                # [u24 ?! duration] [u8 palette] [u8 count of object]
-                dur1, dur2, dur3, palette, num_objects = \
-                    _unpack_from_stream(">5B", stream)
-
-                cur_effect = {
-                    "duration": (dur1 << 16) | (dur2 << 8) | dur3,
-                    "palette": palette,
-                    "objects": [],
-                }
-                _log_dict(cur_effect, "Effect, ")
-                for _1 in range(num_objects):
-                    obj_id, window, x, y = \
-                        _unpack_from_stream(">4H", stream)
-
-                    obj = {
-                        "id": obj_id,
-                        "window": ret["windows"][window],
-                        "x": x,
-                        "y": y,
-                    }
-                    _log_dict(obj, "Object, ")
-                    cur_effect["objects"].append(obj)
-
-                ret["effects"].append(cur_effect)
+    page_ids = []
+    page_offsets = []
+    for _ in range(page_count):
+        page_ids.append(data[offset])
+        page_offsets.append(offset)
+        offset = _skip_page(data, offset)
+
+    ret["pages"] = ButtonPages(data, page_ids, page_offsets)
+    return ret
 
-            return ret
 
-        in_effects = _read_effects()
-        out_effects = _read_effects()
-
-        # [u8 framerate_divider] [u16 def_button] [u16 def_activated]
-        # [u8 palette] [u8 bog_count]
-        framerate_divider, def_button, def_activated, palette, bog_count = \
-            _unpack_from_stream(">BHHBB", stream)
-        cur_page = {
-            "id": page_id,
-            "uo": uo,
-            "in_effects": in_effects,
-            "out_effects": out_effects,
-            "framerate_divider": framerate_divider,
-            "def_button": def_button,
-            "def_activated": def_activated,
-            "palette": palette,
-            "bogs": [],
-        }
-        _log_dict(cur_page, "Page, ")
-        for j in range(bog_count):
-            # [u16 def_button] [u8 button_count]
-            bog_def_button, button_count = _unpack_from_stream(">HB", stream)
-            cur_bog = {
-                "def_button": bog_def_button,
-                "buttons": [],
-            }
-            _log_dict(cur_bog, "BOG, ")
-            for k in range(button_count):
-                # f is u8, others are all u16
-                button_id, v, f, x, y, nu, nd, nl, nr, \
-                    picstart_normal, picstop_normal, flags_normal, \
-                    picstart_selected, picstop_selected, flags_selected, \
-                    picstart_activated, picstop_activated, cmds_count = \
-                    _unpack_from_stream(">HHB" + "H" * 15, stream)
-
-                cur_bog["buttons"].append({
-                    "id": button_id,
-                    "v": v,
-                    "f": f,
-                    "auto_action": bool(f & 128),
-                    "x": x,
-                    "y": y,
-                    "navigation": {
-                        "up": nu,
-                        "down": nd,
-                        "left": nl,
-                        "right": nr,
-                    },
-                    "states": {
-                        "normal": {
-                            "start": picstart_normal,
-                            "stop": picstop_normal,
-                            "flags": flags_normal,
-                        },
-                        "selected": {
-                            "start": picstart_selected,
-                            "stop": picstop_selected,
-                            "flags": flags_selected,
-                        },
-                        "activated": {
-                            "start": picstart_activated,
-                            "stop": picstop_activated,
-                        },
-                    },
-                    # 3 u32 for each command
-                    "commands": [_unpack_from_stream(">III", stream)
-                                 for x in range(cmds_count)],
-                })
-                _log_dict(cur_bog["buttons"][-1], "Button, ")
-
-            cur_page["bogs"].append(cur_bog)
-
-        ret["pages"].append(cur_page)
+def _skip_page(data, offset):
+    # Returns offset of the next page, only counts are read
+    offset += _page_header.size
+    for _ in range(2):
+        # In and out effects
+        window_count = data[offset]
+        offset += 1 + window_count * _effect_window.size
+        effect_count = data[offset]
+        offset += 1
+        for _ in range(effect_count):
+            object_count = data[offset + _effect.size - 1]
+            offset += _effect.size + object_count * _effect_object.size
+
+    bog_count = data[offset + _page_info.size - 1]
+    offset += _page_info.size
+    for _ in range(bog_count):
+        button_count = data[offset + _bog_header.size - 1]
+        offset += _bog_header.size
+        for _ in range(button_count):
+            commands_count, = _u16.unpack_from(
+                data, offset + _button.size - _u16.size,
+            )
+            offset += _button.size + commands_count * _command.size
+
+    if offset > len(data):
+        raise EOFError()
 
-    return ret
+    return offset
 
 
-def igs_parsing_segments(stream):
-    ops = {
-        PALETTE_SEGMENT: parse_palette_segment,
-        PICTURE_SEGMENT: parse_picture_segment,
-        BUTTON_SEGMENT: parse_button_segment,
-        DISPLAY_SEGMENT: lambda x: {},
-    }
-    for seg in igs_raw_segments(stream):
-        op = ops[seg["seg_type"]]
-        seg.update(op(io.BytesIO(seg["raw_data"])))
-        yield seg
+class ButtonPages(Sequence):
+    # Pages of a button segment, each page is parsed when it is accessed.
+    # Pages are not cached, models are supposed to do that.
+    def __init__(self, data, ids, offsets):
+        self.data = data
+        self.ids = ids
+        self.offsets = offsets
 
+    def __len__(self):
+        return len(self.offsets)
 
-def decode_rle(stream, width, height):
-    out_stream = io.BytesIO()
-    pixels_decoded = 0
-    while True:
-        color = stream.read(1)
-        if not color:
-            break
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
 
-        run = 1
+        try:
+            page, _ = _parse_page(self.data, self.offsets[index])
+        except struct.error:
+            raise EOFError()
 
-        if color == b"\x00":
-            flags = ord(_eof_aware_read(stream, 1, True))
-            run = flags & 0x3f
-            if flags & 0x40:
-                run = (run << 8) + ord(_eof_aware_read(stream, 1, True))
+        return page
 
-            color = (_eof_aware_read(stream, 1, True)
-                     if (flags & 0x80) else b"\x00")
+    def __str__(self):
+        return "<ButtonPages ({} pages)>".format(len(self))
+
+
+def _read_bytes(data, offset, length):
+    if offset + length > len(data):
+        raise EOFError()
+
+    return bytes(data[offset:offset + length])
+
+
+parse_palette_segment = _segment_parser(parse_palette_data)
+parse_picture_segment = _segment_parser(parse_picture_data)
+parse_button_segment = _segment_parser(parse_button_data)
+
+
+_segment_data_parsers = {
+    PALETTE_SEGMENT: parse_palette_data,
+    PICTURE_SEGMENT: parse_picture_data,
+    BUTTON_SEGMENT: parse_button_data,
+    DISPLAY_SEGMENT: lambda x: {},
+}
+
+
+def _parse_raw_segment(seg):
+    op = _segment_data_parsers[seg["seg_type"]]
+    with stats.stage("parse"):
+        seg.update(op(memoryview(seg["raw_data"])))
+
+    stats.add("parse", 1, len(seg["raw_data"]))
+    return seg
+
+
+def parse_raw_segments(segments):
+    segments = stats.timed_iter(
+        "segments", segments, lambda x: len(x["raw_data"]),
+    )
+    for seg in segments:
+        yield _parse_raw_segment(seg)
 
-        assert run >= 0
-        if run > 0:
-            out_stream.write(color * run)
-            pixels_decoded += run
-        else:
-            # New line
-            if pixels_decoded % width != 0:
-                raise ValueError("Incorrect number of pixels")
 
-    decoded_data = out_stream.getvalue()
+def igs_parsing_segments(stream):
+    return parse_raw_segments(igs_raw_segments(stream))
+
+
+def decode_rle(stream, width, height):
+    return decode_rle_data(stream.read(), width, height)
+
+
+@stats.timed("rle_decode")
+def decode_rle_data(data, width, height):
+    # Runs of non-zero single pixels are copied in bulk, everything else is
+    # a 0x00 code followed by flags, run length and color. Pixels are
+    # written to a preallocated buffer, which is already filled with
+    # color 0.
+    data = bytes(data)
+    find = data.find
     expected_size = width * height
-    actual_size = len(decoded_data)
-    if actual_size < expected_size:
+    decoded_data = bytearray(expected_size)
+    pixels_decoded = 0
+    position = 0
+    try:
+        while True:
+            code_start = find(b"\x00", position)
+            if code_start != position:
+                if code_start < 0:
+                    code_start = len(data)
+
+                run_end = pixels_decoded + code_start - position
+                if run_end <= expected_size:
+                    decoded_data[pixels_decoded:run_end] = \
+                        data[position:code_start]
+
+                pixels_decoded = run_end
+                if code_start == len(data):
+                    break
+
+            flags = data[code_start + 1]
+            if flags < 0x40:
+                run = flags
+                color = 0
+                position = code_start + 2
+            elif flags < 0x80:
+                run = ((flags & 0x3f) << 8) | data[code_start + 2]
+                color = 0
+                position = code_start + 3
+            elif flags < 0xc0:
+                run = flags & 0x3f
+                color = data[code_start + 2]
+                position = code_start + 3
+            else:
+                run = ((flags & 0x3f) << 8) | data[code_start + 2]
+                color = data[code_start + 3]
+                position = code_start + 4
+
+            if run > 0:
+                run_end = pixels_decoded + run
+                if color and run_end <= expected_size:
+                    decoded_data[pixels_decoded:run_end] = \
+                        _single_bytes[color] * run
+
+                pixels_decoded = run_end
+            elif pixels_decoded % width != 0:
+                # New line
+                raise ValueError("Incorrect number of pixels")
+    except IndexError:
         raise EOFError()
-    elif actual_size > expected_size:
+
+    if pixels_decoded < expected_size:
+        raise EOFError()
+    elif pixels_decoded > expected_size:
         raise ValueError("Expected {} pixels, got {}".format(
-            expected_size, actual_size
+            expected_size, pixels_decoded
         ))
 
-    return decoded_data
+    stats.add("rle_decode", nbytes=expected_size)
+    return bytes(decoded_data)
 
 
 def igs_decoded_segments(stream):
-    pending_pictures = []
-    for seg in igs_parsing_segments(stream):
+    return decode_parsed_segments(igs_parsing_segments(stream))
+
+
+def igs_joined_segments(stream):
+    return join_picture_segments(igs_parsing_segments(stream))
+
+
+def _join_picture_fragment(pending, seg):
+    # pending holds fragments and their total length of the picture being
+    # joined. Returns the joined picture once seg completes it, or None.
+    pending_pictures = pending["fragments"]
+    pending_pictures.append(seg)
+    pending["length"] += len(seg["rle_bitmap_data"])
+    pic_data_length = pending_pictures[0]["rle_bitmap_len"]
+    if pending["length"] < pic_data_length:
+        return None
+
+    if pending["length"] > pic_data_length:
+        raise ValueError("Picture data is too long")
+
+    new_picture = pending_pictures[0].copy()
+    new_picture["rle_bitmap_data"] = b"".join(
+        [x["rle_bitmap_data"] for x in pending_pictures]
+    )
+    del new_picture["rle_bitmap_len"]
+    del new_picture["is_continuation"]
+    pending_pictures.clear()
+    pending["length"] = 0
+    return new_picture
+
+
+def join_picture_segments(segments):
+    # Merges fragments of every picture into one segment, RLE data is kept
+    # compressed in rle_bitmap_data
+    pending = {"fragments": [], "length": 0}
+    for seg in segments:
         if seg["seg_type"] != PICTURE_SEGMENT:
             yield seg
             continue
 
-        pending_pictures.append(seg)
-        cur_data_length = sum(len(x["rle_bitmap_data"])
-                              for x in pending_pictures)
-        pic_data_length = pending_pictures[0]["rle_bitmap_len"]
-        if cur_data_length < pic_data_length:
+        new_picture = _join_picture_fragment(pending, seg)
+        if new_picture is not None:
+            yield new_picture
+
+    if pending["fragments"]:
+        raise EOFError()
+
+
+def decode_parsed_segments(segments):
+    for seg in join_picture_segments(segments):
+        if seg["seg_type"] == PICTURE_SEGMENT:
+            seg["picture_data"] = decode_rle_data(
+                seg.pop("rle_bitmap_data"), seg["width"], seg["height"],
+            )
+
+        yield seg
+
+
+def first_display_set(segments):
+    # A display set is terminated by DISPLAY_SEGMENT, stop as soon as we
+    # have got one that contains the menu
+    have_button_segment = False
+    for seg in segments:
+        yield seg
+        if seg["seg_type"] == BUTTON_SEGMENT:
+            have_button_segment = True
+        elif seg["seg_type"] == DISPLAY_SEGMENT and have_button_segment:
+            return
+
+
+def epoch_display_sets(pid_segments):
+    # Yields (pid, segments) of the first display set of every epoch of
+    # each IGS stream, pid_segments are (pid, raw segment) as yielded by
+    # m2ts_igs_pid_segments. Every stream has its own parsing state, so
+    # only the current display set of each stream is kept in memory, with
+    # pictures joined as soon as their last fragment arrives. If a stream
+    # doesn't start with an epoch, its first display set that has a button
+    # segment is used for it.
+    states = {}
+    pid_segments = stats.timed_iter(
+        "segments", pid_segments, lambda x: len(x[1]["raw_data"]),
+    )
+    for pid, seg in pid_segments:
+        state = states.get(pid)
+        if state is None:
+            state = states[pid] = {
+                "display_set": [],
+                "pending": {"fragments": [], "length": 0},
+                "have_epoch": False,
+            }
+
+        seg = _parse_raw_segment(seg)
+        if seg["seg_type"] == PICTURE_SEGMENT:
+            seg = _join_picture_fragment(state["pending"], seg)
+            if seg is not None:
+                state["display_set"].append(seg)
+
+            continue
+
+        state["display_set"].append(seg)
+        if seg["seg_type"] != DISPLAY_SEGMENT:
             continue
 
-        if cur_data_length > pic_data_length:
-            raise ValueError("Picture data is too long")
+        if _starts_epoch(state["display_set"], state["have_epoch"]):
+            state["have_epoch"] = True
+            yield pid, state["display_set"]
 
-        new_picture = pending_pictures[0].copy()
-        new_picture["picture_data"] = decode_rle(
-            io.BytesIO(b"".join([x["rle_bitmap_data"]
-                       for x in pending_pictures])),
-            new_picture["width"],
-            new_picture["height"],
-        )
-        del new_picture["rle_bitmap_data"]
-        del new_picture["rle_bitmap_len"]
-        del new_picture["is_continuation"]
-        pending_pictures.clear()
-        yield new_picture
+        state["display_set"] = []
 
-    if pending_pictures:
-        raise EOFError()
+    for pid, state in states.items():
+        if _starts_epoch(state["display_set"], state["have_epoch"]):
+            # Stream is truncated, or cut off by the end PTS
+            log.warning("Dropping menu without a display segment at the "
+                        "end of %s", "the stream" if pid is None else
+                        "IGS stream {}".format(pid))
+
+
+def _starts_epoch(display_set, have_epoch):
+    return any(
+        seg["seg_type"] == BUTTON_SEGMENT and (
+            not have_epoch or
+            seg["composition_state"] & COMPOSITION_STATE_EPOCH_START
+        )
+        for seg in display_set
+    )
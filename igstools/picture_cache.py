@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import os
+import struct
+
+from . import stats
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = ".bin"
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+# Evict down to this fraction of max_size, so that eviction doesn't run on
+# every write once the cache is full
+EVICT_TARGET = 0.9
+
+log = logging.getLogger("picture_cache")
+
+
+def picture_key(rle_data, width, height):
+    h = hashlib.sha1(struct.pack(">BHH", CACHE_VERSION, width, height))
+    h.update(rle_data)
+    return h.hexdigest()
+
+
+def rendered_key(picture_key, rgb_palette):
+    # rgb_palette is the output of export._build_rgb_palette, it already
+    # covers palette, matrix and range
+    h = hashlib.sha1(picture_key.encode("ascii"))
+    h.update(rgb_palette)
+    return "{}-{}".format(picture_key, h.hexdigest())
+
+
+class PictureCache:
+    # Stores decoded pictures (and optionally rendered RGBA) in a folder,
+    # one file per entry. Reading an entry updates its mtime, the least
+    # recently used entries are removed once the total size exceeds
+    # max_size. It can be shared by multiple processes.
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, store_rgba=False):
+        self.path = path
+        self.max_size = max_size
+        self.store_rgba = store_rgba
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+        # max_size may be lower than in earlier runs
+        if self.size > self.max_size:
+            self._evict()
+
+    def __str__(self):
+        return "<PictureCache {} ({} bytes)>".format(self.path, self.size)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + CACHE_SUFFIX)
+
+    def _entries(self):
+        # Returns list of (mtime, path, size)
+        ret = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.name.endswith(CACHE_SUFFIX):
+                    continue
+
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                ret.append((stat.st_mtime_ns, entry.path, stat.st_size))
+
+        return ret
+
+    @stats.timed("cache")
+    def get(self, key):
+        # Returns None if the entry doesn't exist
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        log.debug("Cache hit: %s", key)
+        return data
+
+    @stats.timed("cache")
+    def put(self, key, data):
+        path = self._entry_path(key)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "wb") as f:
+            f.write(data)
+
+        os.replace(temp_path, path)
+        self.size += len(data)
+        if self.size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        # Other processes may write to the same folder, so sizes are
+        # counted again here
+        entries = sorted(self._entries())
+        self.size = sum(size for _, _, size in entries)
+        target = self.max_size * EVICT_TARGET
+        for _, path, size in entries:
+            if self.size <= target:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self.size -= size
+
+        log.info("Evicted old entries, %s", self)
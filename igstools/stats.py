@@ -0,0 +1,146 @@
+import functools
+import time
+from contextlib import contextmanager
+
+# Instrumentation of processing stages. Nothing is recorded unless
+# collecting is started by enable(), all helpers below are no-ops
+# otherwise. Time is exclusive: while a nested stage is running, time goes
+# to the nested stage only. Work done in worker processes is not recorded,
+# the time spent waiting for it is.
+
+_active = None
+
+
+class Stats:
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+        self._stack = []
+        self._last = self.started
+
+    def _entry(self, name):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = {"time": 0.0, "items": 0, "bytes": 0}
+            self.stages[name] = entry
+
+        return entry
+
+    def _switch(self):
+        now = time.perf_counter()
+        if self._stack:
+            self._entry(self._stack[-1])["time"] += now - self._last
+
+        self._last = now
+
+    def push(self, name):
+        self._switch()
+        self._stack.append(name)
+
+    def pop(self):
+        self._switch()
+        self._stack.pop()
+
+    def add(self, name, items=0, nbytes=0):
+        entry = self._entry(name)
+        entry["items"] += items
+        entry["bytes"] += nbytes
+
+    def to_dict(self):
+        return {
+            "wall_time": time.perf_counter() - self.started,
+            "stages": {
+                name: entry.copy() for name, entry in self.stages.items()
+            },
+        }
+
+
+def enable():
+    # Starts collecting into a new Stats object and returns it
+    global _active
+    _active = Stats()
+    return _active
+
+
+def disable():
+    global _active
+    ret, _active = _active, None
+    return ret
+
+
+@contextmanager
+def stage(name):
+    s = _active
+    if s is None:
+        yield
+        return
+
+    s.push(name)
+    try:
+        yield
+    finally:
+        s.pop()
+
+
+def add(name, items=0, nbytes=0):
+    if _active is not None:
+        _active.add(name, items, nbytes)
+
+
+def timed(name):
+    # Decorator, counts calls of the function as items
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            s = _active
+            if s is None:
+                return func(*args, **kwargs)
+
+            s.add(name, 1)
+            s.push(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                s.pop()
+
+        return _wrapper
+
+    return _decorator
+
+
+def timed_iter(name, iterable, size=None):
+    # Times every step of the iterable, size returns byte count of an item
+    if _active is None:
+        return iterable
+
+    return _timed_iter(_active, name, iter(iterable), size)
+
+
+def _timed_iter(s, name, iterator, size):
+    while True:
+        s.push(name)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            s.pop()
+
+        s.add(name, 1, size(item) if size else 0)
+        yield item
+
+
+def format_report(data):
+    lines = ["{:<16}{:>10}{:>10}{:>14}".format(
+        "stage", "time (s)", "items", "bytes",
+    )]
+    stages = sorted(
+        data["stages"].items(), key=lambda x: x[1]["time"], reverse=True,
+    )
+    for name, entry in stages:
+        lines.append("{:<16}{:>10.3f}{:>10}{:>14}".format(
+            name, entry["time"], entry["items"], entry["bytes"],
+        ))
+
+    lines.append("{:<16}{:>10.3f}".format("wall time", data["wall_time"]))
+    return "\n".join(lines)
@@ -0,0 +1,358 @@
+# Generator of synthetic IGS menus and M2TS files, for benchmarks and for
+# checking the parser against known data.
+#
+# Layout of generated menus: every page has the same buttons, each button
+# has its own animation of `frames` pictures for normal and selected state
+# and a single picture for activated state. Buttons are placed on a grid
+# that wraps around the menu.
+
+import random
+import struct
+
+from .parser import (
+    PALETTE_SEGMENT, PICTURE_SEGMENT, BUTTON_SEGMENT, DISPLAY_SEGMENT,
+    COMPOSITION_STATE_EPOCH_START,
+)
+from .ts_reader import (
+    BLURAY_HEADER_SIZE, TS_PACKET_SIZE, SYNC_BYTE, STREAM_TYPE_IGS,
+)
+
+# Every segment goes into one PES packet, whose 16-bit length also covers
+# the PES header ([u8 flags] [u8 flags] [u8 header_len] [5 bytes PTS]) and
+# segment type and length
+PES_HEADER_SIZE = 8
+MAX_SEGMENT_SIZE = 0xffff - PES_HEADER_SIZE - 3
+PICTURE_HEADER_SIZE = 4
+PICTURE_INFO_SIZE = 7
+MAX_RUN = 0x3fff
+
+PMT_PID = 0x100
+VIDEO_PID = 0x1011
+IGS_PID = 0x1400
+STREAM_TYPE_H264 = 0x1b
+PROGRAM_NUMBER = 1
+# One segment every 0.1 second. PCR base (90kHz) advances by PCR_STEP every
+# packet and is sent on every PCR_INTERVAL video packets.
+PTS_STEP = 9000
+PCR_STEP = 300
+PCR_INTERVAL = 10
+
+_segment_header = struct.Struct(">2sIIBH")
+_picture_header = struct.Struct(">HBB")
+_button = struct.Struct(">HHB" + "H" * 15)
+
+
+def rle_encode(pixels, width, height):
+    # Same coding as parser.decode_rle_data: single non-zero pixels are
+    # stored as is, everything else as 0x00 [flags] [run] [color]
+    ret = bytearray()
+    for y in range(height):
+        line = pixels[y * width:(y + 1) * width]
+        x = 0
+        while x < width:
+            color = line[x]
+            run = 1
+            while (x + run < width and line[x + run] == color and
+                   run < MAX_RUN):
+                run += 1
+
+            if color != 0 and run <= 2:
+                ret += bytes((color,)) * run
+            else:
+                flags = (0x40 if run > 0x3f else 0) | (0x80 if color else 0)
+                ret.append(0)
+                if run > 0x3f:
+                    ret += bytes((flags | (run >> 8), run & 0xff))
+                else:
+                    ret.append(flags | run)
+
+                if color:
+                    ret.append(color)
+
+            x += run
+
+        ret += b"\x00\x00"
+
+    return bytes(ret)
+
+
+def random_picture(width, height, rnd):
+    # Runs of random length, with a mix of transparent and colored pixels.
+    # Color 0xff is never used, as in real menus.
+    ret = bytearray()
+    for _ in range(height):
+        x = 0
+        while x < width:
+            run = min(width - x, rnd.choice((1, 1, 2, 3, 5, 20, 100)))
+            color = rnd.choice((0, rnd.randrange(1, 255)))
+            ret += bytes((color,)) * run
+            x += run
+
+    return bytes(ret)
+
+
+def segment(seg_type, data, pts=0, dts=0):
+    if len(data) > MAX_SEGMENT_SIZE:
+        raise ValueError("Segment is too large: {} bytes".format(len(data)))
+
+    return _segment_header.pack(b"IG", pts, dts, seg_type, len(data)) + data
+
+
+def palette_segment(rnd, palette_id=0, color_count=255):
+    # [u8 palette_id] [u8 version] then [u8 id] [u8 y] [u8 cr] [u8 cb]
+    # [u8 alpha] for each color
+    data = bytearray((palette_id, 0))
+    for color_id in range(color_count):
+        data += bytes((
+            color_id,
+            rnd.randrange(16, 236),
+            rnd.randrange(16, 241),
+            rnd.randrange(16, 241),
+            rnd.randrange(256),
+        ))
+
+    return segment(PALETTE_SEGMENT, bytes(data))
+
+
+def picture_segments(picture_id, width, height, pixels):
+    # Returns list of segments, RLE data is split into fragments if it
+    # doesn't fit into one segment
+    rle_data = rle_encode(pixels, width, height)
+    first_size = MAX_SEGMENT_SIZE - PICTURE_HEADER_SIZE - PICTURE_INFO_SIZE
+    fragments = [rle_data[:first_size]]
+    position = first_size
+    while position < len(rle_data):
+        next_position = position + MAX_SEGMENT_SIZE - PICTURE_HEADER_SIZE
+        fragments.append(rle_data[position:next_position])
+        position = next_position
+
+    ret = []
+    for i, fragment in enumerate(fragments):
+        sequence = (0x80 if i == 0 else 0) | \
+            (0x40 if i == len(fragments) - 1 else 0)
+        data = _picture_header.pack(picture_id, 0, sequence)
+        if i == 0:
+            data += (len(rle_data) + 4).to_bytes(3, "big")
+            data += struct.pack(">HH", width, height)
+
+        ret.append(segment(PICTURE_SEGMENT, data + fragment))
+
+    return ret
+
+
+def _effects(window_size):
+    # One window and one effect that shows it
+    return (
+        b"\x01" + struct.pack(">BHHHH", 0, 0, 0, window_size, window_size) +
+        b"\x01" + bytes((0, 0, 10, 0, 1)) + struct.pack(">4H", 0, 0, 5, 5)
+    )
+
+
+def button_segment(
+    width, height, pages, bogs, buttons, frames, picture_width,
+    picture_height,
+):
+    # Button IDs are unique in each page, picture IDs are shared by all
+    # pages, see picture_ids
+    data = struct.pack(
+        ">HHBHBB", width, height, 0x20, 0, COMPOSITION_STATE_EPOCH_START,
+        0xc0,
+    )
+    # [u24 data_len] [u8 model_flags] [u24 user_timeout_duration]
+    data += b"\x00\x00\x00" + b"\x80" + b"\x00\x00\x00"
+    data += bytes((pages,))
+    columns = max(width // picture_width, 1)
+    rows = max(height // picture_height, 1)
+    button_count = bogs * buttons
+    for page_id in range(pages):
+        data += struct.pack(">BBQ", page_id, 0, 0)
+        data += _effects(min(width, height))
+        data += _effects(min(width, height))
+        data += struct.pack(">BHHBB", 1, 0, 0xffff, 0, bogs)
+        for bog in range(bogs):
+            first = bog * buttons
+            data += struct.pack(">HB", first, buttons)
+            for button_id in range(first, first + buttons):
+                prev_id = (button_id - 1) % button_count
+                next_id = (button_id + 1) % button_count
+                normal, selected, activated = picture_ids(button_id, frames)
+                slot = button_id % (columns * rows)
+                data += _button.pack(
+                    button_id, 0, 0,
+                    (slot % columns) * picture_width,
+                    (slot // columns) * picture_height,
+                    prev_id, next_id, prev_id, next_id,
+                    normal[0], normal[-1], 0,
+                    selected[0], selected[-1], 0,
+                    activated, activated,
+                    1,
+                )
+                # Jump to title of the button ID
+                data += struct.pack(">III", 0x21820000, button_id, 0)
+
+    return segment(BUTTON_SEGMENT, data)
+
+
+def picture_ids(button_id, frames):
+    # Returns (normal IDs, selected IDs, activated ID) of a button
+    first = button_id * (frames * 2 + 1)
+    return (
+        range(first, first + frames),
+        range(first + frames, first + frames * 2),
+        first + frames * 2,
+    )
+
+
+def display_segment():
+    return segment(DISPLAY_SEGMENT, b"")
+
+
+def make_menu(
+    width=1920, height=1080, pages=2, bogs=3, buttons=2, frames=1,
+    picture_width=100, picture_height=60, seed=0,
+):
+    # Returns (menu data, {picture_id: pixels})
+    rnd = random.Random(seed)
+    pictures = {}
+    segments = [
+        button_segment(
+            width, height, pages, bogs, buttons, frames,
+            picture_width, picture_height,
+        ),
+        palette_segment(rnd),
+    ]
+    for button_id in range(bogs * buttons):
+        normal, selected, activated = picture_ids(button_id, frames)
+        for picture_id in list(normal) + list(selected) + [activated]:
+            pixels = random_picture(picture_width, picture_height, rnd)
+            pictures[picture_id] = pixels
+            segments.extend(picture_segments(
+                picture_id, picture_width, picture_height, pixels,
+            ))
+
+    segments.append(display_segment())
+    return b"".join(segments), pictures
+
+
+def _timestamp(value, marker):
+    return bytes((
+        (marker << 4) | (((value >> 30) & 7) << 1) | 1,
+        (value >> 22) & 0xff,
+        (((value >> 15) & 0x7f) << 1) | 1,
+        (value >> 7) & 0xff,
+        ((value & 0x7f) << 1) | 1,
+    ))
+
+
+def ts_packet(pid, payload, pusi=False, cc=0, pcr=None):
+    # Payload shorter than 184 bytes is padded with adaptation field
+    adaptation = b""
+    if pcr is not None:
+        adaptation = b"\x10" + struct.pack(
+            ">IH", (pcr >> 1) & 0xffffffff, ((pcr & 1) << 15) | 0x7e00,
+        )
+
+    header = SYNC_BYTE + struct.pack(">H", (0x4000 if pusi else 0) | pid)
+    room = TS_PACKET_SIZE - len(header) - 1
+    if not adaptation and len(payload) == room:
+        return header + bytes((0x10 | (cc & 0xf),)) + payload
+
+    stuffing = room - 1 - len(adaptation) - len(payload)
+    if stuffing < 0:
+        raise ValueError("Payload is too large")
+
+    if not adaptation and stuffing > 0:
+        adaptation = b"\x00"
+        stuffing -= 1
+
+    adaptation += b"\xff" * stuffing
+    return (header + bytes((0x30 | (cc & 0xf), len(adaptation))) +
+            adaptation + payload)
+
+
+def _psi_packet(pid, table_id, section):
+    # section_length covers CRC, which is not checked by the reader
+    length = len(section) + 4
+    data = bytes((0, table_id, 0xb0 | (length >> 8), length & 0xff))
+    data += section + b"\x00" * 4
+    return ts_packet(pid, data + b"\xff" * (184 - len(data)), True)
+
+
+def _pat_packet():
+    section = struct.pack(">HBBB", 1, 0xc1, 0, 0)
+    section += struct.pack(">HH", PROGRAM_NUMBER, 0xe000 | PMT_PID)
+    return _psi_packet(0, 0, section)
+
+
+def _pmt_packet(igs_pids):
+    section = struct.pack(
+        ">HBBBHH", PROGRAM_NUMBER, 0xc1, 0, 0, 0xe000 | VIDEO_PID, 0xf000,
+    )
+    section += struct.pack(">BHH", STREAM_TYPE_H264, 0xe000 | VIDEO_PID,
+                           0xf000)
+    for pid in igs_pids:
+        section += struct.pack(">BHH", STREAM_TYPE_IGS, 0xe000 | pid, 0xf000)
+
+    return _psi_packet(PMT_PID, 2, section)
+
+
+def pes_packets(menu, pid):
+    # Every segment goes into its own PES packet, with increasing PTS
+    ret = []
+    position = 0
+    cc = 0
+    pts = 0
+    while position < len(menu):
+        _, _, _, _, seg_length = _segment_header.unpack_from(menu, position)
+        # PES payload is the segment without the fake "IG" header
+        body = menu[position + 10:position + _segment_header.size +
+                    seg_length]
+        position += _segment_header.size + seg_length
+        pts += PTS_STEP
+        header = b"\x81\x80\x05" + _timestamp(pts, 2)
+        assert len(header) == PES_HEADER_SIZE
+        pes = b"\x00\x00\x01\xbd" + struct.pack(
+            ">H", len(header) + len(body),
+        ) + header + body
+        for i in range(0, len(pes), 184):
+            ret.append(ts_packet(pid, pes[i:i + 184], i == 0, cc))
+            cc += 1
+
+    return ret
+
+
+def make_m2ts(menus, filler=1000, seed=0):
+    # menus is a list of (PID, menu data). IGS packets are spread evenly
+    # between filler video packets, which carry PCR.
+    rnd = random.Random(seed)
+    packets = [_pat_packet(), _pmt_packet([pid for pid, _ in menus])]
+    queues = [pes_packets(menu, pid) for pid, menu in menus]
+    igs = []
+    while any(queues):
+        for queue in queues:
+            if queue:
+                igs.append(queue.pop(0))
+
+    igs.reverse()
+    total = len(igs) + filler
+    interval = max(1, total // (len(igs) + 1))
+    video_count = 0
+    for i in range(total):
+        if igs and i % interval == 0:
+            packets.append(igs.pop())
+            continue
+
+        pcr = None
+        payload_size = 184
+        if video_count % PCR_INTERVAL == 0:
+            pcr = i * PCR_STEP
+            payload_size = 176
+
+        payload = bytes(rnd.getrandbits(8) for _ in range(8))
+        payload = payload * (payload_size // 8)
+        packets.append(ts_packet(VIDEO_PID, payload, False, video_count, pcr))
+        video_count += 1
+
+    igs.reverse()
+    packets.extend(igs)
+    return b"".join(b"\x00" * BLURAY_HEADER_SIZE + p for p in packets)
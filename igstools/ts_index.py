@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+import os
+
+from .ts_reader import STREAM_TYPE_IGS
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".igsidx"
+HEADER_HASH_SIZE = 65536
+
+log = logging.getLogger("ts_index")
+
+
+def _file_key(stream):
+    stat = os.fstat(stream.fileno())
+    position = stream.tell()
+    stream.seek(0)
+    header_hash = hashlib.sha1(stream.read(HEADER_HASH_SIZE)).hexdigest()
+    stream.seek(position)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "header_hash": header_hash,
+    }
+
+
+def _dump_pid_info(pid_info):
+    ret = {}
+    for pid, info in pid_info.items():
+        if info["type"] not in ("pmt", "stream"):
+            continue
+
+        info = info.copy()
+        if "es_descriptor" in info:
+            info["es_descriptor"] = bytes(info["es_descriptor"]).hex()
+
+        ret[str(pid)] = info
+
+    return ret
+
+
+def _load_pid_info(data):
+    ret = {}
+    for pid, info in data.items():
+        if "es_descriptor" in info:
+            info["es_descriptor"] = bytes.fromhex(info["es_descriptor"])
+
+        ret[int(pid)] = info
+
+    return ret
+
+
+class PacketIndex:
+    # Records PAT/PMT results and offsets of all IGS packets in a M2TS file,
+    # see ts_reader.igs_demuxer_iter for how it is used
+    def __init__(self, key):
+        self.key = key
+        self.pid_info = {}
+        self.offsets = []
+        self.end_offset = 0
+        self.complete = False
+        self._saved_state = None
+
+    def __str__(self):
+        return "<PacketIndex ({} packets{})>".format(
+            len(self.offsets), ", complete" if self.complete else "",
+        )
+
+    @property
+    def igs_pids(self):
+        return sorted(
+            pid for pid, info in self.pid_info.items()
+            if info.get("stream_type") == STREAM_TYPE_IGS
+        )
+
+    def _state(self):
+        return (len(self.offsets), self.end_offset, self.complete)
+
+    @classmethod
+    def load(cls, stream, path):
+        # Returns an empty index if the file doesn't exist or is stale
+        ret = cls(_file_key(stream))
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return ret
+
+        if data.get("version") != INDEX_VERSION or data.get("key") != ret.key:
+            log.info("Ignoring stale index %s", path)
+            return ret
+
+        ret.pid_info = _load_pid_info(data["pid_info"])
+        ret.offsets = data["offsets"]
+        ret.end_offset = data["end_offset"]
+        ret.complete = data["complete"]
+        ret._saved_state = ret._state()
+        log.info("Loaded %s from %s", ret, path)
+        return ret
+
+    def save(self, path):
+        if self._state() == self._saved_state:
+            return
+
+        data = {
+            "version": INDEX_VERSION,
+            "key": self.key,
+            "pid_info": _dump_pid_info(self.pid_info),
+            "igs_pids": self.igs_pids,
+            "offsets": self.offsets,
+            "end_offset": self.end_offset,
+            "complete": self.complete,
+        }
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+
+        os.replace(temp_path, path)
+        self._saved_state = self._state()
+        log.info("Saved %s to %s", self, path)
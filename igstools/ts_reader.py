@@ -1,77 +1,367 @@
 import logging
 import io
+import mmap
+import multiprocessing
+import os
+import stat
 import struct
 
+from . import stats
 from .utils import eof_aware_read, log_dict, unpack_from_stream
 
+BLURAY_HEADER_SIZE = 4
 TS_PACKET_SIZE = 188
+M2TS_PACKET_SIZE = BLURAY_HEADER_SIZE + TS_PACKET_SIZE
 TS_MAX_PACKET_SIZE = 204
 PROBE_PACKETS = 2048
+SCAN_CHUNK_SIZE = M2TS_PACKET_SIZE * 4096
+PARALLEL_REGION_SIZE = M2TS_PACKET_SIZE * 65536
+PCR_SEARCH_PACKETS = 8192
+# Segments may be muxed well ahead of their PTS, start a bit earlier when
+# seeking
+SEEK_MARGIN = 90000 * 5
 SYNC_BYTE = b"\x47"
 STREAM_TYPE_IGS = 0x91
 
 log = logging.getLogger("ts_reader")
 
+_packet_header = struct.Struct(">HB")
+_segment_header = struct.Struct(">2sII")
 
-def raw_packets(stream):
+
+def _map_stream(stream):
+    try:
+        fileno = stream.fileno()
+        offset = stream.tell()
+    except (AttributeError, OSError):
+        return None
+
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ), offset
+    except (OSError, ValueError):
+        # Pipes, character devices and empty files can't be mapped
+        return None
+
+
+def _scan_buffer(data, pos, base, at_eof):
+    # Yields (offset, packet) for whole packets in data[pos:], returns the
+    # position where scanning stopped. Packets are zero-copy memoryviews.
+    # When more data will follow, enough bytes are kept back so that a
+    # resync search never runs past the end of the buffer.
+    view = memoryview(data)
+    end = len(data)
+    reserve = M2TS_PACKET_SIZE + TS_MAX_PACKET_SIZE
     while True:
-        stream.read(4)  # Bluray header
-        skipped_bytes = 0
-        try:
-            for i in range(TS_MAX_PACKET_SIZE):
-                byte = stream.read(1)
-                if not byte:
-                    return
+        sync = pos + BLURAY_HEADER_SIZE
+        if sync + TS_PACKET_SIZE <= end and data[sync] == SYNC_BYTE[0]:
+            pos = sync + TS_PACKET_SIZE
+            yield base + sync, view[sync:pos]
+            continue
 
-                if byte == SYNC_BYTE:
-                    break
+        if not at_eof and end - pos < reserve:
+            return pos
 
-                skipped_bytes += 1
-            else:
-                raise ValueError("Can't find sync byte in the stream")
+        found = data.find(SYNC_BYTE, sync, sync + TS_MAX_PACKET_SIZE)
+        if found < 0:
+            if sync + TS_MAX_PACKET_SIZE >= end:
+                return end
+
+            raise ValueError("Can't find sync byte in the stream")
+
+        log.debug("Skipped %d bytes", found - sync)
+        pos = found + TS_PACKET_SIZE
+        if pos > end:
+            raise EOFError()
+
+        yield base + found, view[found:pos]
+
+
+def scan_packets(stream):
+    mapped = _map_stream(stream)
+    if mapped:
+        data, offset = mapped
+        try:
+            yield from _scan_buffer(data, offset, 0, True)
         finally:
-            if skipped_bytes:
-                log.debug("Skipped %d bytes", skipped_bytes)
+            try:
+                data.close()
+            except BufferError:
+                # Some packets are still referenced, let GC unmap it
+                pass
+
+        return
+
+    try:
+        base = stream.tell()
+    except (AttributeError, OSError):
+        base = 0
+
+    data = b""
+    pos = 0
+    while True:
+        chunk = stream.read(SCAN_CHUNK_SIZE)
+        data = data[pos:] + chunk
+        base += pos
+        pos = yield from _scan_buffer(data, 0, base, not chunk)
+        if not chunk:
+            return
+
+
+def _find_region_start(data, pos):
+    # Regions may not start on a packet boundary if the stream has been
+    # resynced before, look for two consecutive sync bytes in that case.
+    # Returns None if there are none.
+    for start in range(pos, pos + M2TS_PACKET_SIZE):
+        sync = start + BLURAY_HEADER_SIZE
+        if (data[sync:sync + 1] == SYNC_BYTE and
+                data[sync + M2TS_PACKET_SIZE:
+                     sync + M2TS_PACKET_SIZE + 1] in (SYNC_BYTE, b"")):
+            return start
+
+    return None
+
+
+def _scan_range(f, start, end, pids):
+    # Scans from packet start offset start, returns ((offset, packet) of
+    # packets on the given PIDs that start before end, start of the first
+    # packet after them or None at end of file)
+    ret = []
+    f.seek(start)
+    scanner = scan_packets(f)
+    try:
+        for offset, packet in scanner:
+            packet_start = offset - BLURAY_HEADER_SIZE
+            if packet_start >= end:
+                return ret, packet_start
+
+            if packet_pid(packet) in pids:
+                ret.append((offset, bytes(packet)))
+    finally:
+        scanner.close()
+
+    return ret, None
+
+
+def _scan_region(args):
+    # Worker of _scan_packets_after_probe, returns (first packet start,
+    # next packet start, packets) of the region, see _scan_range. The first
+    # packet is guessed unless exact is set, first packet start is None if
+    # that fails or the region can't be scanned.
+    path, start, end, pids, exact = args
+    try:
+        with open(path, "rb") as f:
+            if not exact:
+                f.seek(start)
+                region_start = _find_region_start(
+                    f.read(M2TS_PACKET_SIZE * 3), 0,
+                )
+                if region_start is None:
+                    return None, None, []
+
+                start += region_start
+
+            packets, next_start = _scan_range(f, start, end, pids)
+    except (ValueError, EOFError):
+        # Scanned again from where the previous region ended, which raises
+        # the error if it isn't caused by a wrong guess
+        return None, None, []
+
+    return start, next_start, packets
+
+
+def _igs_pids(pid_info):
+    return {
+        pid for pid, info in pid_info.items()
+        if info.get("stream_type") == STREAM_TYPE_IGS
+    }
+
+
+def _is_regular_file(stream):
+    try:
+        return (isinstance(stream.name, str) and
+                stat.S_ISREG(os.fstat(stream.fileno()).st_mode))
+    except (AttributeError, OSError):
+        return False
+
+
+def _probe_packets(stream, pid_info):
+    # Scans sequentially until PIDs of IGS streams are known, returns offset
+    # of the next packet, or None if the stream ends before that
+    if _igs_pids(pid_info):
+        return stream.tell()
+
+    scanner = scan_packets(stream)
+    try:
+        for offset, packet in scanner:
+            yield offset, packet
+            pid = packet_pid(packet)
+            if (pid_info.get(pid, {}).get("type") == "pmt" and
+                    _igs_pids(pid_info)):
+                return offset + TS_PACKET_SIZE
+    finally:
+        scanner.close()
+
+    return None
+
+
+def _pcr_after(stream, offset):
+    stream.seek(offset)
+    scanner = scan_packets(stream)
+    try:
+        for i, (_, packet) in enumerate(scanner):
+            if i >= PCR_SEARCH_PACKETS:
+                break
+
+            pcr = packet_pcr(packet)
+            if pcr is not None:
+                return pcr
+    finally:
+        scanner.close()
+
+    return None
+
+
+def _seek_to_pcr(stream, position, pcr):
+    # Bisects [position, end of file) for the last packet before the given
+    # PCR. Assumes PCR increases monotonically in the file.
+    size = os.fstat(stream.fileno()).st_size
+    low = 0
+    high = (size - position) // M2TS_PACKET_SIZE
+    while high - low > 1:
+        middle = (low + high) // 2
+        middle_pcr = _pcr_after(stream, position + middle * M2TS_PACKET_SIZE)
+        if middle_pcr is None or middle_pcr >= pcr:
+            high = middle
+        else:
+            low = middle
+
+    log.debug("Seeking to packet #%d for PCR %d", low, pcr)
+    return position + low * M2TS_PACKET_SIZE
+
+
+def _scan_packets_after_probe(stream, pid_info, workers=1, seek_pcr=None):
+    # Once IGS streams are found, seeks to seek_pcr if given, and scans the
+    # rest of the file for packets on those PIDs in a process pool if
+    # workers > 1. Later changes of PAT/PMT are not picked up in both cases.
+    if not _is_regular_file(stream):
+        log.debug("Stream is not a regular file, scanning sequentially")
+        yield from scan_packets(stream)
+        return
+
+    position = yield from _probe_packets(stream, pid_info)
+    if position is None:
+        return
+
+    if seek_pcr is not None:
+        position = _seek_to_pcr(stream, position, seek_pcr)
+
+    if workers <= 1:
+        stream.seek(position)
+        yield from scan_packets(stream)
+        return
+
+    size = os.fstat(stream.fileno()).st_size
+    pids = _igs_pids(pid_info)
+    regions = [
+        (stream.name, region_start, region_start + PARALLEL_REGION_SIZE, pids,
+         region_start == position)
+        for region_start in range(position, size, PARALLEL_REGION_SIZE)
+    ]
+    log.debug("Scanning %d regions with %d workers", len(regions), workers)
+    # Each region must continue exactly where the previous one stopped, as
+    # sequential scanning would. If its first packet was guessed wrong
+    # after a resync, it is scanned again from there.
+    next_start = position
+    with multiprocessing.Pool(workers) as pool:
+        for region, (first_start, region_next_start, region_packets) in zip(
+            regions, pool.imap(_scan_region, regions),
+        ):
+            if next_start is None:
+                break
+
+            if first_start != next_start:
+                log.debug("Rescanning region at %d from %d", region[1],
+                          next_start)
+                with open(stream.name, "rb") as f:
+                    region_packets, region_next_start = _scan_range(
+                        f, next_start, region[2], pids,
+                    )
+
+            next_start = region_next_start
+            yield from region_packets
+
+
+def raw_packets(stream):
+    for _, packet in scan_packets(stream):
+        yield packet
+
+
+def _data_size(item):
+    # Byte count of (offset or PID, data) tuples, for stats
+    return len(item[1])
 
-        yield SYNC_BYTE + eof_aware_read(stream, TS_PACKET_SIZE - 1, True)
 
+def packet_pid(packet):
+    return ((packet[1] & 0x1f) << 8) | packet[2]
 
-def packets(raw_packets):
+
+def packet_pcr(packet):
+    # Returns the 33-bit base of PCR, or None if the packet doesn't carry it
+    if not (packet[3] & 0x20 and packet[4] > 0 and packet[5] & 0x10):
+        return None
+
+    return ((packet[6] << 25) | (packet[7] << 17) | (packet[8] << 9) |
+            (packet[9] << 1) | (packet[10] >> 7))
+
+
+def packets(raw_packets, pids=None):
+    # If pids is given, packets on other PIDs are skipped without being
+    # parsed. The set may be updated while iterating.
     for packet in raw_packets:
-        packet_stream = io.BytesIO(packet)
-        packet_stream.read(1)
-        flags1, flags2 = unpack_from_stream(">HB", packet_stream)
-        parsed_packet = {
-            "transport_error": bool(flags1 & 0x8000),
-            "payload_unit_start": bool(flags1 & 0x4000),
-            "transport_priority": bool(flags1 & 0x2000),
-            "pid": flags1 & 0x1fff,
-            "scrambling_control": (flags2 & 0xc0) >> 6,
-            "has_adaptation_field": bool(flags2 & 0x20),
-            "has_payload": bool(flags2 & 0x10),
-            "continuity_counter": flags2 & 0xf,
-        }
-        if parsed_packet["has_adaptation_field"]:
-            field_length = ord(eof_aware_read(packet_stream, 1, True))
-            field_data = eof_aware_read(
-                packet_stream, field_length, True,
-            )
-            if field_length > 0:
-                parsed_packet["adaptation_field_data"] = field_data
-                field_flag = field_data[0]
-                parsed_packet["adaptation_field"] = {
-                    "discontinuity": bool(field_flag & 0x80),
-                    "random_access": bool(field_flag & 0x40),
-                    "priority": bool(field_flag & 0x20),
-                    "has_pcr": bool(field_flag & 0x10),
-                    "has_opcr": bool(field_flag & 0x8),
-                    "has_splicing_point": bool(field_flag & 0x4),
-                    "has_private_data": bool(field_flag & 0x2),
-                    "has_extension": bool(field_flag & 0x1),
-                }
-
-        parsed_packet["payload"] = packet_stream.read()
-        yield parsed_packet
+        if pids is not None and packet_pid(packet) not in pids:
+            continue
+
+        yield parse_packet(packet)
+
+
+def parse_packet(packet):
+    flags1, flags2 = _packet_header.unpack_from(packet, 1)
+    parsed_packet = {
+        "transport_error": bool(flags1 & 0x8000),
+        "payload_unit_start": bool(flags1 & 0x4000),
+        "transport_priority": bool(flags1 & 0x2000),
+        "pid": flags1 & 0x1fff,
+        "scrambling_control": (flags2 & 0xc0) >> 6,
+        "has_adaptation_field": bool(flags2 & 0x20),
+        "has_payload": bool(flags2 & 0x10),
+        "continuity_counter": flags2 & 0xf,
+    }
+    payload_start = 4
+    if parsed_packet["has_adaptation_field"]:
+        field_length = packet[4]
+        payload_start = 5 + field_length
+        if payload_start > len(packet):
+            raise EOFError()
+
+        if field_length > 0:
+            field_data = packet[5:payload_start]
+            parsed_packet["adaptation_field_data"] = field_data
+            field_flag = field_data[0]
+            parsed_packet["adaptation_field"] = {
+                "discontinuity": bool(field_flag & 0x80),
+                "random_access": bool(field_flag & 0x40),
+                "priority": bool(field_flag & 0x20),
+                "has_pcr": bool(field_flag & 0x10),
+                "has_opcr": bool(field_flag & 0x8),
+                "has_splicing_point": bool(field_flag & 0x4),
+                "has_private_data": bool(field_flag & 0x2),
+                "has_extension": bool(field_flag & 0x1),
+            }
+            if field_flag & 0x10:
+                parsed_packet["adaptation_field"]["pcr"] = packet_pcr(packet)
+
+    parsed_packet["payload"] = packet[payload_start:]
+    return parsed_packet
 
 
 def parse_psi_table(packet):
@@ -121,42 +411,213 @@ def streams_from_pmt(packet):
         }
 
 
-def igs_demuxer_iter(stream):
+def _update_pid_info(p, pid_info):
+    # Adds programs or streams in a PAT or PMT packet to pid_info, returns
+    # the new entries
+    if pid_info[p["pid"]]["type"] == "pat":
+        new_info = list(programs_from_pat(p))
+        info_type = "pmt"
+    else:
+        new_info = list(streams_from_pmt(p))
+        info_type = "stream"
+
+    for info in new_info:
+        pid_info[info["pid"]] = info
+        info["type"] = info_type
+        log_dict(log, info)
+
+    return new_info
+
+
+def probe_igs_pids(stream):
+    # Returns PIDs of IGS streams, only the first PROBE_PACKETS packets are
+    # read
     pid_info = {
         0: {"type": "pat"}
     }
-    packet_count = 0
+    scanner = scan_packets(stream)
+    try:
+        for i, (_, packet) in enumerate(scanner):
+            if i >= PROBE_PACKETS:
+                break
+
+            pid = packet_pid(packet)
+            if pid_info.get(pid, {}).get("type") not in ("pat", "pmt"):
+                continue
+
+            _update_pid_info(parse_packet(packet), pid_info)
+            pids = _igs_pids(pid_info)
+            if pids:
+                return pids
+    finally:
+        scanner.close()
+
+    return set()
+
+
+def _parse_timestamp(data, offset):
+    return ((((data[offset] >> 1) & 0x7) << 30) |
+            (data[offset + 1] << 22) |
+            ((data[offset + 2] >> 1) << 15) |
+            (data[offset + 3] << 7) |
+            (data[offset + 4] >> 1))
+
+
+def pes_timestamps(payload):
+    # Returns (pts, dts) of a PES packet, DTS defaults to PTS if missing
+    pts_dts_flags = payload[7] >> 6
+    if not pts_dts_flags & 0x2:
+        return None, None
+
+    pts = _parse_timestamp(payload, 9)
+    dts = _parse_timestamp(payload, 14) if pts_dts_flags == 3 else pts
+    return pts, dts
+
+
+def _igs_payloads(p, pes_state, start, end):
+    payload = p["payload"]
+    if p["payload_unit_start"]:
+        assert payload[:3] == b"\x00\x00\x01"
+        pts, dts = pes_timestamps(payload)
+        pts = pts or 0
+        dts = dts or 0
+        if end is not None and pts > end:
+            pes_state["ended"] = True
+            return
+
+        pes_state["accepted"] = start is None or pts >= start
+        if not pes_state["accepted"]:
+            return
+
+        # Same as header of segments in menu files
+        yield _segment_header.pack(b"IG", pts & 0xffffffff, dts & 0xffffffff)
+        pes_header_length = payload[8] + 9
+        payload = payload[pes_header_length:]
+    elif not pes_state["accepted"]:
+        # Only happens if we are started in the middle of a PES packet
+        return
+
+    yield payload
+
+
+def igs_pid_demuxer_iter(
+    stream, index=None, workers=1, start=None, end=None,
+):
+    # Yields (pid, data) of all IGS streams, PES packets of each stream are
+    # reassembled separately.
+    # If index is given, packets recorded in it are read directly, then
+    # scanning resumes where it stopped last time. Newly found packets are
+    # recorded into it.
+    # If workers > 1, the file is scanned in parallel once IGS streams are
+    # found.
+    # If start or end is given, only PES packets with PTS in [start, end]
+    # are returned. The file is bisected by PCR to find where to start.
+    pid_info = {
+        0: {"type": "pat"}
+    }
+    pes_states = {}
+
+    def _pid_payloads(p):
+        # Returns True once all IGS streams have passed end, packets of a
+        # stream that has passed it are dropped
+        pes_state = pes_states.setdefault(
+            p["pid"], {"accepted": False, "ended": False},
+        )
+        if pes_state["ended"]:
+            return False
+
+        for data in _igs_payloads(p, pes_state, start, end):
+            yield p["pid"], data
+
+        return pes_state["ended"] and all(
+            pes_states.get(pid, {}).get("ended")
+            for pid, info in pid_info.items()
+            if info.get("stream_type") == STREAM_TYPE_IGS
+        )
+
     have_igs = False
-    for p in packets(raw_packets(stream)):
-        pid = p["pid"]
-        if pid not in pid_info:
+    if index is not None:
+        pid_info.update(index.pid_info)
+        index.pid_info = pid_info
+        for offset in index.offsets:
+            stream.seek(offset)
+            packet = eof_aware_read(stream, TS_PACKET_SIZE, True)
+            if (yield from _pid_payloads(parse_packet(packet))):
+                return
+
+            have_igs = True
+
+        if index.complete:
+            return
+
+        stream.seek(index.end_offset)
+
+    # Only PAT, PMTs and IGS streams are parsed, everything else is just
+    # counted by its PID
+    wanted_pids = {0}
+    wanted_pids.update(
+        pid for pid, info in pid_info.items()
+        if info["type"] == "pmt" or
+        info.get("stream_type") == STREAM_TYPE_IGS
+    )
+    packet_count = 0
+    if workers > 1 or start is not None:
+        scanner = _scan_packets_after_probe(
+            stream, pid_info, workers,
+            None if start is None else max(start - SEEK_MARGIN, 0),
+        )
+    else:
+        scanner = scan_packets(stream)
+
+    scanner = stats.timed_iter("ts_scan", scanner, _data_size)
+    for offset, packet in scanner:
+        pid = packet_pid(packet)
+        if pid in wanted_pids:
+            p = parse_packet(packet)
+            if pid_info[pid]["type"] in ("pat", "pmt"):
+                for info in _update_pid_info(p, pid_info):
+                    if info["type"] == "pmt":
+                        wanted_pids.add(info["pid"])
+                    elif info["stream_type"] == STREAM_TYPE_IGS:
+                        wanted_pids.add(info["pid"])
+                        if start is not None:
+                            # We will seek away from here, there may be
+                            # no IGS packet close to where we seek to
+                            have_igs = True
+                    else:
+                        wanted_pids.discard(info["pid"])
+            else:
+                if index is not None:
+                    index.offsets.append(offset)
+                    index.end_offset = offset + TS_PACKET_SIZE
+
+                if (yield from _pid_payloads(p)):
+                    return
+
+                have_igs = True
+        elif pid not in pid_info:
             log.debug("Unknown PID: %d", pid)
             pid_info[pid] = {"type": "unknown"}
             continue
 
-        packet_type = pid_info[pid]["type"]
-        if packet_type == "pat":
-            for program in programs_from_pat(p):
-                pid_info[program["pid"]] = program
-                program["type"] = "pmt"
-                log_dict(log, program)
-        elif packet_type == "pmt":
-            for stream_info in streams_from_pmt(p):
-                pid_info[stream_info["pid"]] = stream_info
-                stream_info["type"] = "stream"
-                log_dict(log, stream_info)
-        elif (packet_type == "stream" and
-              pid_info[pid]["stream_type"] == STREAM_TYPE_IGS):
-            payload = p["payload"]
-            if p["payload_unit_start"]:
-                yield b"IG" + b"\x00" * 8
-                assert payload[:3] == b"\x00\x00\x01"
-                pes_header_length = payload[8] + 9
-                payload = payload[pes_header_length:]
-
-            yield payload
-            have_igs = True
-
         packet_count += 1
         if not have_igs and packet_count > PROBE_PACKETS:
             raise ValueError("Can't find IGS stream")
+
+    if index is not None:
+        index.complete = True
+
+
+def igs_demuxer_iter(stream, **kwargs):
+    # Only returns data of the first IGS stream that has any, see
+    # igs_pid_demuxer_iter for arguments
+    igs_pid = None
+    for pid, data in stats.timed_iter(
+        "pes", igs_pid_demuxer_iter(stream, **kwargs), _data_size,
+    ):
+        if igs_pid is None:
+            igs_pid = pid
+        elif pid != igs_pid:
+            continue
+
+        yield data
@@ -1,3 +1,4 @@
+import logging
 import struct
 
 
@@ -26,11 +27,44 @@ def unpack_from_stream(fmt, stream):
     return struct.unpack(fmt, data)
 
 
+class PrefixedStream:
+    # Reads from prefix first, then from stream
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, count=-1):
+        if not self.prefix:
+            return self.stream.read(count)
+
+        if count < 0:
+            ret = self.prefix + self.stream.read()
+            self.prefix = b""
+            return ret
+
+        ret = self.prefix[:count]
+        self.prefix = self.prefix[count:]
+        if len(ret) < count:
+            ret += self.stream.read(count - len(ret))
+
+        return ret
+
+    def readinto(self, b):
+        with memoryview(b) as target:
+            count = min(len(self.prefix), target.nbytes)
+            target[:count] = self.prefix[:count]
+            self.prefix = self.prefix[count:]
+            if count < target.nbytes:
+                count += self.stream.readinto(target[count:]) or 0
+
+        return count
+
+
 def dump_dict(d):
     def _dump_value(v):
         if isinstance(v, dict):
             return "{{{}}}".format(dump_dict(v))
-        elif isinstance(v, (bytes, list)):
+        elif isinstance(v, (bytes, bytearray, memoryview, list)):
             return "<Len: {}>".format(len(v))
 
         return str(v)
@@ -40,4 +74,7 @@ def dump_dict(d):
 
 
 def log_dict(log, d, prefix=""):
-    log.debug(prefix + dump_dict(d))
+    # dump_dict is expensive for large segments, skip it if it won't be
+    # logged anyway
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(prefix + dump_dict(d))